@@ -3,12 +3,38 @@ AI-powered vacancy filtering using Google Gemini.
 Scores vacancies based on relevance to user preferences.
 """
 
+import asyncio
+import contextlib
+import hashlib
+import json
 import logging
+import re
 import google.generativeai as genai
 import config
+import relevance
+import storage
+from hh_client import Vacancy
+from ratelimit import TokenBucket
 
 logger = logging.getLogger(__name__)
 
+# Bump when the scoring prompt or its answer format changes: cached scores are keyed by it
+PROMPT_VERSION = 1
+
+GEMINI_MODEL = 'models/gemini-flash-latest'
+
+# Score given to vacancies the local pre-filter rejected: not an AI score, never shown as one
+KEYWORD_MISS = -2
+
+# Provider quota: concurrent requests plus per-minute request and token budgets
+_request_semaphore = asyncio.Semaphore(max(1, config.AI_MAX_CONCURRENCY))
+_rpm_limiter = TokenBucket(config.AI_RPM / 60, burst=max(1, config.AI_MAX_CONCURRENCY))
+_tpm_limiter = TokenBucket(config.AI_TPM / 60, burst=config.AI_TPM)
+
+# Rough answer sizes, for the token budget
+SCORE_OUTPUT_TOKENS = 150  # Per scored vacancy
+LETTER_OUTPUT_TOKENS = 400
+
 # Configure Gemini
 _model = None
 
@@ -26,6 +52,20 @@ if config.AI_PROVIDER in ["openai", "groq"]:
         logger.error("openai library not installed. Please install 'openai' package.")
 
 
+def _estimate_tokens(prompt: str, output_tokens: int) -> int:
+    """Rough token count of a request: ~3 characters per prompt token plus the expected answer."""
+    return len(prompt) // 3 + output_tokens
+
+
+@contextlib.asynccontextmanager
+async def _ai_slot(prompt: str, output_tokens: int):
+    """Hold a provider request slot: waits for concurrency, RPM and TPM budgets."""
+    async with _request_semaphore:
+        await _rpm_limiter.acquire()
+        await _tpm_limiter.acquire(_estimate_tokens(prompt, output_tokens))
+        yield
+
+
 def _get_model():
     """Get or create Gemini model instance."""
     global _model
@@ -42,56 +82,56 @@ def _get_model():
             logger.error(f"Failed to list models: {e}")
 
         # Use available flash model
-        _model = genai.GenerativeModel('models/gemini-flash-latest')
+        _model = genai.GenerativeModel(GEMINI_MODEL)
     return _model
 
 
-async def score_vacancy(vacancy_data: dict, user_prefs: dict = None) -> tuple[int, dict]:
+def _vacancy_details(vacancy: Vacancy) -> str:
+    """Vacancy fields as prompt lines."""
+    title = vacancy.name or "Не указано"
+    salary_str = vacancy.salary_text() or "Не указана"
+    employer = vacancy.employer or "Не указан"
+    requirements = vacancy.requirement or "Не указаны"
+    responsibility = vacancy.responsibility or "Не указаны"
+    area = vacancy.area or "Не указан"
+    experience = vacancy.experience or "Не указан"
+    
+    return f"""- Название: {title}
+- Компания: {employer}
+- Зарплата: {salary_str}
+- Локация: {area}
+- Опыт: {experience}
+- Требования: {requirements[:800]}
+- Обязанности: {responsibility[:800]}"""
+
+
+_SCORING_TASK = """1. Оцени релевантность (0-100).
+2. Выдели стек технологий (кратко, через запятую).
+3. Напиши 2-3 главных плюса (кратко).
+4. Напиши 1-2 минуса или риски (кратко). Отсутствие зарплаты МИНУСОМ НЕ СЧИТАТЬ.
+5. Напиши краткий вердикт (одним предложением)."""
+
+
+def _search_query(user_prefs: dict) -> str:
+    return user_prefs.get("search_query", config.SEARCH_QUERY) if user_prefs else config.SEARCH_QUERY
+
+
+async def score_vacancy(vacancy: Vacancy, user_prefs: dict = None) -> tuple[int, dict]:
     """Score vacancy using configured AI provider."""
     
     # 1. Prepare Prompt (Common for all)
-    title = vacancy_data.get("name", "Не указано")
-    salary = vacancy_data.get("salary")
-    salary_str = "Не указана"
-    if salary:
-        salary_from = salary.get("from")
-        salary_to = salary.get("to")
-        currency = salary.get("currency", "")
-        if salary_from and salary_to:
-            salary_str = f"{salary_from} - {salary_to} {currency}"
-        elif salary_from:
-            salary_str = f"от {salary_from} {currency}"
-        elif salary_to:
-            salary_str = f"до {salary_to} {currency}"
-            
-    employer = vacancy_data.get("employer", {}).get("name", "Не указан")
-    snippet = vacancy_data.get("snippet", {})
-    requirements = snippet.get("requirement") or "Не указаны"
-    responsibility = snippet.get("responsibility") or "Не указаны"
-    area = vacancy_data.get("area", {}).get("name", "Не указан")
-    experience = vacancy_data.get("experience", {}).get("name", "Не указан")
-    
-    search_query = user_prefs.get("search_query", config.SEARCH_QUERY) if user_prefs else config.SEARCH_QUERY
+    title = vacancy.name or "Не указано"
+    search_query = _search_query(user_prefs)
     
     prompt = f"""Ты HR-эксперт. Оцени релевантность вакансии для соискателя.
 
 ПОИСКОВЫЙ ЗАПРОС СОИСКАТЕЛЯ: {search_query}
 
 ВАКАНСИЯ:
-- Название: {title}
-- Компания: {employer}
-- Зарплата: {salary_str}
-- Локация: {area}
-- Опыт: {experience}
-- Требования: {requirements[:800]}
-- Обязанности: {responsibility[:800]}
+{_vacancy_details(vacancy)}
 
 ЗАДАЧА:
-1. Оцени релевантность (0-100).
-2. Выдели стек технологий (кратко, через запятую).
-3. Напиши 2-3 главных плюса (кратко).
-4. Напиши 1-2 минуса или риски (кратко). Отсутствие зарплаты МИНУСОМ НЕ СЧИТАТЬ.
-5. Напиши краткий вердикт (одним предложением).
+{_SCORING_TASK}
 
 ФОРМАТ ОТВЕТА (JSON):
 {{
@@ -103,30 +143,191 @@ async def score_vacancy(vacancy_data: dict, user_prefs: dict = None) -> tuple[in
 }}
 Ответь ТОЛЬКО валидным JSON."""
 
-    # 2. Select Provider
     if not config.AI_FILTER_ENABLED:
         logger.warning(f"AI filtering is disabled.")
         return -1, {}
 
+    # 2. Reuse a cached score for the same vacancy, query, prompt and model
+    model = _model_id()
+    fingerprint = _prefs_fingerprint(search_query)
+    if vacancy.id:
+        cached = storage.get_ai_score(vacancy.id, fingerprint, PROMPT_VERSION, model, config.AI_SCORE_CACHE_DAYS)
+        if cached:
+            logger.info(f"AI score for '{title}' taken from cache: {cached[0]}/100")
+            return cached
+    
+    score, reasoning = await _score_prompt(prompt, title, SCORE_OUTPUT_TOKENS)
+    # Failures (-1) are not cached, so they are retried next time
+    if vacancy.id and score >= 0:
+        storage.save_ai_score(vacancy.id, fingerprint, PROMPT_VERSION, model, score, reasoning)
+    return score, reasoning
+
+
+async def score_vacancies(vacancies: list, user_prefs: dict = None) -> dict:
+    """
+    Score many vacancies, packing up to AI_BATCH_SIZE of them into one prompt.
+    
+    Cached scores are reused and the local relevance pre-filter settles clear
+    cases (KEYWORD_MISS for misses, -1 for hits); entries a batch answer is
+    missing or garbles are scored one by one, a failed batch is left at -1.
+    Returns {vacancy_id: (score, reasoning)}.
+    """
+    if not config.AI_FILTER_ENABLED:
+        return {vac.id: (-1, {}) for vac in vacancies}
+    
+    search_query = _search_query(user_prefs)
+    model = _model_id()
+    fingerprint = _prefs_fingerprint(search_query)
+    
+    results = {}
+    pending = []
+    seen = set()
+    for vac in vacancies:
+        if vac.id in seen:
+            continue
+        seen.add(vac.id)
+        cached = storage.get_ai_score(vac.id, fingerprint, PROMPT_VERSION, model, config.AI_SCORE_CACHE_DAYS) if vac.id else None
+        if cached:
+            results[vac.id] = cached
+        else:
+            pending.append(vac)
+    if results:
+        logger.info(f"AI scores for {len(results)} vacancies taken from cache")
+    
+    # Cheap first stage: clear misses get KEYWORD_MISS, clear hits go out unscored (-1)
+    if config.RELEVANCE_FILTER_ENABLED and pending:
+        resume_text = user_prefs.get("resume_text") if user_prefs else None
+        rejected, accepted, pending = relevance.triage(pending, search_query, resume_text)
+        for vac in rejected:
+            results[vac.id] = (KEYWORD_MISS, {})
+        for vac in accepted:
+            results[vac.id] = (-1, {})
+    
+    # Batches (and per-item fallbacks) run concurrently; the provider limiter paces them
+    async def _score_chunk(batch: list) -> dict:
+        scored = await _score_batch(batch, search_query) if len(batch) > 1 else {}
+        for vac_id, (score, reasoning) in scored.items():
+            if score >= 0:
+                storage.save_ai_score(vac_id, fingerprint, PROMPT_VERSION, model, score, reasoning)
+        missing = [vac for vac in batch if vac.id not in scored]
+        singles = await asyncio.gather(*(score_vacancy(vac, user_prefs) for vac in missing))
+        scored.update(zip((vac.id for vac in missing), singles))
+        return scored
+    
+    batch_size = max(1, config.AI_BATCH_SIZE)
+    chunks = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    for scored in await asyncio.gather(*(_score_chunk(chunk) for chunk in chunks)):
+        results.update(scored)
+    
+    return results
+
+
+async def _score_batch(vacancies: list, search_query: str) -> dict:
+    """
+    Score several vacancies with one prompt. Returns {vacancy_id: (score, reasoning)}
+    for valid answers; a failed request or an answer without a results list gives
+    -1 for the whole batch rather than one more request per vacancy.
+    """
+    details = "\n\n".join(f"[id: {vac.id}]\n{_vacancy_details(vac)}" for vac in vacancies)
+    
+    prompt = f"""Ты HR-эксперт. Оцени релевантность каждой вакансии для соискателя.
+
+ПОИСКОВЫЙ ЗАПРОС СОИСКАТЕЛЯ: {search_query}
+
+ВАКАНСИИ:
+{details}
+
+ЗАДАЧА (для КАЖДОЙ вакансии):
+{_SCORING_TASK}
+
+ФОРМАТ ОТВЕТА (JSON):
+{{
+  "results": [
+    {{
+      "id": "123",
+      "score": 85,
+      "stack": "React, TypeScript, Redux, Docker",
+      "pros": "Удаленка, ДМС, Крупная компания",
+      "cons": "Легаси код, Овертаймы",
+      "verdict": "Отличный вариант для роста, но возможны переработки."
+    }}
+  ]
+}}
+Верни ровно по одному объекту на каждую вакансию, с её id.
+Ответь ТОЛЬКО валидным JSON."""
+
+    data = await _request_json(prompt, SCORE_OUTPUT_TOKENS * len(vacancies))
+    items = data.get("results") if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        logger.warning(f"AI batch request failed, {len(vacancies)} vacancies left unscored")
+        return {vac.id: (-1, {}) for vac in vacancies}
+    
+    titles = {vac.id: vac.name or "Не указано" for vac in vacancies}
+    scored = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        vac_id = str(item.get("id", ""))
+        if vac_id not in titles or vac_id in scored:
+            continue
+        try:
+            scored[vac_id] = _parse_ai_response(item, titles[vac_id])
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Bad AI batch entry for {vac_id}: {e}")
+    
+    if len(scored) < len(vacancies):
+        logger.warning(f"AI batch scored {len(scored)}/{len(vacancies)} vacancies, the rest go one by one")
+    return scored
+
+
+def _model_id() -> str:
+    """Provider and model the scores come from (part of the score cache key)."""
+    if config.AI_PROVIDER == "gemini":
+        return f"gemini:{GEMINI_MODEL}"
+    return f"{config.AI_PROVIDER}:{config.OPENAI_MODEL}"
+
+
+def _prefs_fingerprint(search_query: str) -> str:
+    """Short hash of the user inputs the scoring prompt depends on."""
+    normalized = " ".join(str(search_query).lower().split())
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:16]
+
+
+async def _score_prompt(prompt: str, title: str, output_tokens: int) -> tuple[int, dict]:
+    """Send a scoring prompt to the configured provider."""
+    data = await _request_json(prompt, output_tokens)
+    if not isinstance(data, dict):
+        return -1, {}
+    try:
+        return _parse_ai_response(data, title)
+    except (TypeError, ValueError) as e:
+        logger.error(f"Bad AI answer for '{title}': {e}")
+        return -1, {}
+
+
+async def _request_json(prompt: str, output_tokens: int):
+    """Send a prompt to the configured provider and return its parsed JSON answer, or None."""
     if config.AI_PROVIDER == "gemini":
         if not config.GEMINI_API_KEY:
             logger.error("Gemini API key not configured.")
-            return -1, {}
-        return await _score_gemini(prompt, title)
+            return None
+        async with _ai_slot(prompt, output_tokens):
+            return await _json_gemini(prompt)
     elif config.AI_PROVIDER in ["openai", "groq"]:
         if not config.OPENAI_API_KEY:
             logger.error(f"{config.AI_PROVIDER} API key not configured.")
-            return -1, {}
-        return await _score_openai(prompt, title)
+            return None
+        async with _ai_slot(prompt, output_tokens):
+            return await _json_openai(prompt)
     else:
         logger.error(f"Unknown AI provider: {config.AI_PROVIDER}")
-        return -1, {}
+        return None
 
-async def _score_openai(prompt: str, title: str) -> tuple[int, dict]:
-    """Score using OpenAI/Groq API."""
+async def _json_openai(prompt: str):
+    """Ask OpenAI/Groq API for a JSON answer."""
     if not openai_client:
         logger.error("OpenAI client not initialized")
-        return -1, {}
+        return None
         
     try:
         response = await openai_client.chat.completions.create(
@@ -140,23 +341,18 @@ async def _score_openai(prompt: str, title: str) -> tuple[int, dict]:
         )
         
         text = response.choices[0].message.content
-        import json
-        data = json.loads(text)
-        return _parse_ai_response(data, title)
+        return json.loads(text)
         
     except Exception as e:
         logger.error(f"OpenAI/Groq scoring failed: {e}")
-        return -1, {}
+        return None
 
-async def _score_gemini(prompt: str, title: str) -> tuple[int, dict]:
-    """Score using Google Gemini API."""
-    import asyncio
-    import re
-    
+async def _json_gemini(prompt: str):
+    """Ask Google Gemini API for a JSON answer."""
     model = _get_model() # Ensure model is initialized
     if not model:
         logger.error("Gemini model not initialized")
-        return -1, {}
+        return None
 
     retries = 3
     base_delay = 5
@@ -170,9 +366,7 @@ async def _score_gemini(prompt: str, title: str) -> tuple[int, dict]:
             if text.startswith("```"):
                 text = text.strip("`").replace("json", "").strip()
                 
-            import json
-            data = json.loads(text)
-            return _parse_ai_response(data, title)
+            return json.loads(text)
             
         except Exception as e:
             error_str = str(e)
@@ -184,14 +378,15 @@ async def _score_gemini(prompt: str, title: str) -> tuple[int, dict]:
                 else:
                     wait_time = base_delay * (2 ** attempt)
                 logger.info(f"Sleeping for {wait_time:.1f}s...")
+                _rpm_limiter.pause(wait_time)  # Hold the other queued requests too
                 await asyncio.sleep(wait_time)
                 continue
             
             logger.error(f"AI scoring failed: {e}")
-            return -1, {}
+            return None
 
     logger.error("AI scoring failed after max retries")
-    return -1, {}
+    return None
 
 def _parse_ai_response(data: dict, title: str) -> tuple[int, dict]:
     """Helper to parse common JSON format."""
@@ -209,19 +404,21 @@ def _parse_ai_response(data: dict, title: str) -> tuple[int, dict]:
 
 def should_send_vacancy(score: int) -> bool:
     """Check if vacancy should be sent based on AI score."""
+    if score == KEYWORD_MISS:
+        return False
     if score < 0:
         return True
     return score >= config.MIN_AI_SCORE
 
 
-async def generate_cover_letter(vacancy_data: dict, resume_text: str) -> str:
+async def generate_cover_letter(vacancy: Vacancy, resume_text: str) -> str:
     """Generate a cover letter based on vacancy and resume."""
     
     # 1. Prepare Context
-    title = vacancy_data.get("name", "Не указано")
-    employer = vacancy_data.get("employer", {}).get("name", "Не указан")
-    requirements = (vacancy_data.get("snippet", {}).get("requirement") or "")[:800]
-    responsibility = (vacancy_data.get("snippet", {}).get("responsibility") or "")[:800]
+    title = vacancy.name or "Не указано"
+    employer = vacancy.employer or "Не указан"
+    requirements = vacancy.requirement[:800]
+    responsibility = vacancy.responsibility[:800]
     
     prompt = f"""Ты помогаешь соискателю написать сопроводительное письмо (Cover Letter).
 
@@ -250,9 +447,11 @@ async def generate_cover_letter(vacancy_data: dict, resume_text: str) -> str:
         return "⚠️ AI выключен в настройках."
 
     if config.AI_PROVIDER in ["openai", "groq"]:
-        return await _generate_text_openai(prompt)
+        async with _ai_slot(prompt, LETTER_OUTPUT_TOKENS):
+            return await _generate_text_openai(prompt)
     elif config.AI_PROVIDER == "gemini":
-        return await _generate_text_gemini(prompt)
+        async with _ai_slot(prompt, LETTER_OUTPUT_TOKENS):
+            return await _generate_text_gemini(prompt)
     else:
         return "⚠️ Неизвестный AI провайдер."
 
@@ -0,0 +1,69 @@
+"""
+Small in-process caches shared by the bot modules.
+"""
+
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """LRU cache with a size limit and optional per-entry time-to-live (seconds)."""
+
+    def __init__(self, max_size: int, ttl: float = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (stored_at, value), oldest first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return a fresh cached value and mark it as recently used."""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        stored_at, value = entry
+        if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Store a value, evicting least recently used entries over max_size."""
+        if self.max_size <= 0:
+            return
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        """Remove a key, returning its value (expired or not)."""
+        entry = self._data.pop(key, None)
+        return entry[1] if entry else default
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        """Counters for logging and /stats."""
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
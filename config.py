@@ -13,6 +13,18 @@ SEARCH_QUERIES = [q.strip() for q in SEARCH_QUERY.split(",") if q.strip()]
 
 CHECK_INTERVAL_SECONDS = int(os.getenv("CHECK_INTERVAL_SECONDS", "600"))
 
+# Incremental polling: re-check this many minutes before the last seen publication
+# (HH indexes some vacancies late), and never page further than POLL_MAX_PAGES
+# pages of 100 vacancies
+POLL_OVERLAP_MINUTES = int(os.getenv("POLL_OVERLAP_MINUTES", "10"))
+POLL_MAX_PAGES = int(os.getenv("POLL_MAX_PAGES", "10"))
+
+# Polling pipeline (fetch -> dedupe -> score -> outbox): workers per stage and
+# queue size between stages (a full queue pauses the stages before it)
+PIPELINE_FETCH_CONCURRENCY = int(os.getenv("PIPELINE_FETCH_CONCURRENCY", "2"))
+PIPELINE_SCORE_CONCURRENCY = int(os.getenv("PIPELINE_SCORE_CONCURRENCY", "2"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "50"))
+
 # Filters
 MIN_SALARY = int(os.getenv("MIN_SALARY", "0"))  # Minimum salary filter (0 = disabled)
 EXPERIENCE = os.getenv("EXPERIENCE", "")  # noExperience, between1And3, between3And6, moreThan6
@@ -24,11 +36,57 @@ REMOTE_ONLY = os.getenv("REMOTE_ONLY", "").lower() == "true"
 # Schedule filter for remote work
 SCHEDULE = "remote" if REMOTE_ONLY else ""
 
+# Telegram flood limits: messages per second for the whole bot and per chat,
+# per minute in groups; flood waits and network errors are retried TG_MAX_RETRIES times
+# (sends only when the request never went out)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_GROUP_PER_MINUTE = int(os.getenv("TG_GROUP_PER_MINUTE", "20"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3"))
+
+# Outbox: queued vacancy messages are delivered on arrival and re-checked every
+# OUTBOX_POLL_SECONDS; a failed message is retried no sooner than OUTBOX_POLL_SECONDS
+# later (doubling per attempt) and given up after OUTBOX_MAX_ATTEMPTS failures
+OUTBOX_POLL_SECONDS = int(os.getenv("OUTBOX_POLL_SECONDS", "30"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+
+# HH API HTTP client
+HH_USER_AGENT = os.getenv("HH_USER_AGENT", "hhVacanciesBot/1.0")
+HH_HTTP2 = os.getenv("HH_HTTP2", "true").lower() == "true"
+HH_TIMEOUT = float(os.getenv("HH_TIMEOUT", "15"))  # Read/write/pool timeout, seconds
+HH_CONNECT_TIMEOUT = float(os.getenv("HH_CONNECT_TIMEOUT", "5"))
+HH_MAX_CONNECTIONS = int(os.getenv("HH_MAX_CONNECTIONS", "10"))
+HH_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HH_MAX_KEEPALIVE_CONNECTIONS", "5"))
+HH_KEEPALIVE_EXPIRY = float(os.getenv("HH_KEEPALIVE_EXPIRY", "60"))
+HH_MAX_CONCURRENT_REQUESTS = int(os.getenv("HH_MAX_CONCURRENT_REQUESTS", "4"))  # Global, all queries
+HH_RATE_LIMIT = float(os.getenv("HH_RATE_LIMIT", "5"))  # Requests per second (0 = unlimited)
+HH_RATE_BURST = int(os.getenv("HH_RATE_BURST", "10"))
+HH_MAX_RETRIES = int(os.getenv("HH_MAX_RETRIES", "4"))  # On 429 / 5xx / network errors
+HH_BACKOFF_BASE = float(os.getenv("HH_BACKOFF_BASE", "1"))  # Seconds, doubled per attempt
+HH_BACKOFF_MAX = float(os.getenv("HH_BACKOFF_MAX", "30"))
+HH_PAGE_CONCURRENCY = int(os.getenv("HH_PAGE_CONCURRENCY", "3"))  # Pages fetched ahead in deep search
+
+# Identical HH searches within this window are served from memory (0 = disabled)
+HH_CACHE_TTL_SECONDS = float(os.getenv("HH_CACHE_TTL_SECONDS", "60"))
+HH_CACHE_MAX_ENTRIES = int(os.getenv("HH_CACHE_MAX_ENTRIES", "256"))
+
+# Vacancy data kept for message buttons: in memory (LRU, TTL) and in the DB
+VACANCY_CACHE_SIZE = int(os.getenv("VACANCY_CACHE_SIZE", "1000"))
+VACANCY_CACHE_TTL_SECONDS = int(os.getenv("VACANCY_CACHE_TTL_SECONDS", str(24 * 3600)))
+VACANCY_STORE_DAYS = int(os.getenv("VACANCY_STORE_DAYS", "30"))
+# How often old stored vacancies, delivered outbox messages and AI scores are pruned
+PRUNE_INTERVAL_SECONDS = int(os.getenv("PRUNE_INTERVAL_SECONDS", str(24 * 3600)))
+
+# SQLite tuning: page cache size and memory-mapped I/O
+SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", "16384"))
+SQLITE_MMAP_MB = int(os.getenv("SQLITE_MMAP_MB", "64"))
+
 # AI Configuration
 AI_FILTER_ENABLED = os.getenv("AI_FILTER_ENABLED", "true").lower() == "true"
 MIN_AI_SCORE = int(os.getenv("MIN_AI_SCORE", "70"))
 
-# Provider: 'gemini' or 'openai' (works for Groq too)
+# Provider: 'gemini', 'openai' or 'groq' (an OpenAI-compatible API; 'openai' with a Groq
+# OPENAI_BASE_URL works too and gets Groq's limits)
 AI_PROVIDER = os.getenv("AI_PROVIDER", "gemini").lower()
 
 # Gemini Config
@@ -39,5 +97,30 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") # Optional, e.g. for Groq
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "llama-3.3-70b-versatile") # Default OpenAI/Groq model
 
-# Target Chat ID
-TARGET_CHAT_ID = None
+# How long an AI score is reused for the same vacancy, query, prompt and model
+AI_SCORE_CACHE_DAYS = int(os.getenv("AI_SCORE_CACHE_DAYS", "7"))
+
+# Vacancies scored per LLM request (1 = one request per vacancy)
+AI_BATCH_SIZE = int(os.getenv("AI_BATCH_SIZE", "10"))
+
+# Local relevance pre-filter: below REJECT (0..1 BM25 match of title/snippets to the
+# query; the default only rejects vacancies with no query term) is skipped, and a
+# resume covering at least ACCEPT of the title's words is sent; the rest goes to the AI
+RELEVANCE_FILTER_ENABLED = os.getenv("RELEVANCE_FILTER_ENABLED", "true").lower() == "true"
+RELEVANCE_REJECT_BELOW = float(os.getenv("RELEVANCE_REJECT_BELOW", "0.01"))
+RELEVANCE_ACCEPT_ABOVE = float(os.getenv("RELEVANCE_ACCEPT_ABOVE", "0.9"))
+
+# AI request limits: concurrent requests, requests and tokens per minute (0 = unlimited).
+# Defaults follow each provider's free tier (picked by the API host for OPENAI_BASE_URL);
+# raise them for paid quotas.
+_AI_LIMIT_DEFAULTS = {
+    "gemini": (1, 10, 250000),
+    "groq": (4, 30, 12000),
+    "openai": (8, 500, 200000),
+}
+_groq_url = "groq.com" in (OPENAI_BASE_URL or "").lower()
+_limits_provider = "groq" if AI_PROVIDER == "openai" and _groq_url else AI_PROVIDER
+_ai_limits = _AI_LIMIT_DEFAULTS.get(_limits_provider, (1, 10, 0))
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", str(_ai_limits[0])))
+AI_RPM = int(os.getenv("AI_RPM", str(_ai_limits[1])))
+AI_TPM = int(os.getenv("AI_TPM", str(_ai_limits[2])))
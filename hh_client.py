@@ -1,38 +1,193 @@
+import asyncio
+import html
 import httpx
 import logging
+import sys
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
 import config
+from cache import TTLCache
+from ratelimit import TokenBucket, backoff_delay
 
 logger = logging.getLogger(__name__)
 
-async def get_vacancies(
+API_URL = "https://api.hh.ru/vacancies"
+PUBLISHED_AT_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+MAX_PER_PAGE = 100  # HH API limit
+
+# Shared HTTP client (created once per application, see init_client/close_client)
+_client: httpx.AsyncClient = None
+
+# Global budget of HH requests, shared by all callers: requests per second and concurrency
+_rate_limiter = TokenBucket(config.HH_RATE_LIMIT, burst=config.HH_RATE_BURST)
+_request_semaphore = asyncio.Semaphore(config.HH_MAX_CONCURRENT_REQUESTS)
+
+# Short-lived response cache and in-flight requests ({"task", "waiters"}), keyed by normalized params
+_response_cache = TTLCache(config.HH_CACHE_MAX_ENTRIES, ttl=config.HH_CACHE_TTL_SECONDS)
+_in_flight: dict = {}
+
+
+class Vacancy:
+    """
+    Compact vacancy record with only the fields the bot uses.
+    Parsed once from the HH API item; repeated strings are interned.
+    """
+    __slots__ = (
+        "id", "name", "employer", "area",
+        "salary_from", "salary_to", "salary_currency",
+        "experience", "requirement", "responsibility",
+        "url", "published_at",
+    )
+
+    def __init__(
+        self,
+        id: str,
+        name: str = "",
+        employer: str = "",
+        area: str = "",
+        salary_from: int = None,
+        salary_to: int = None,
+        salary_currency: str = "",
+        experience: str = "",
+        requirement: str = "",
+        responsibility: str = "",
+        url: str = "",
+        published_at: str = ""
+    ):
+        self.id = id
+        self.name = name
+        self.employer = employer
+        self.area = area
+        self.salary_from = salary_from
+        self.salary_to = salary_to
+        self.salary_currency = salary_currency
+        self.experience = experience
+        self.requirement = requirement
+        self.responsibility = responsibility
+        self.url = url
+        self.published_at = published_at
+
+    @classmethod
+    def from_api(cls, item: dict) -> "Vacancy":
+        """Build from an HH API 'items' entry."""
+        salary = item.get("salary") or {}
+        snippet = item.get("snippet") or {}
+        return cls(
+            id=item.get("id"),
+            name=item.get("name") or "",
+            employer=sys.intern((item.get("employer") or {}).get("name") or ""),
+            area=sys.intern((item.get("area") or {}).get("name") or ""),
+            salary_from=salary.get("from"),
+            salary_to=salary.get("to"),
+            salary_currency=sys.intern(salary.get("currency") or ""),
+            experience=sys.intern((item.get("experience") or {}).get("name") or ""),
+            requirement=snippet.get("requirement") or "",
+            responsibility=snippet.get("responsibility") or "",
+            url=item.get("alternate_url") or "",
+            published_at=item.get("published_at") or "",
+        )
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Vacancy":
+        """Inverse of to_dict (unknown keys are ignored)."""
+        return cls(**{k: data[k] for k in cls.__slots__ if k in data})
+
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    @property
+    def has_salary(self) -> bool:
+        return bool(self.salary_from or self.salary_to)
+
+    def salary_text(self) -> str:
+        """Plain salary range, e.g. 'от 150000 RUR'. Empty if not specified."""
+        currency = self.salary_currency
+        if self.salary_from and self.salary_to:
+            return f"{self.salary_from} - {self.salary_to} {currency}"
+        elif self.salary_from:
+            return f"от {self.salary_from} {currency}"
+        elif self.salary_to:
+            return f"до {self.salary_to} {currency}"
+        return ""
+
+    def __repr__(self):
+        return f"Vacancy(id={self.id!r}, name={self.name!r})"
+
+
+def _http2_available() -> bool:
+    """HTTP/2 needs the optional 'h2' package (pip install httpx[http2])."""
+    if not config.HH_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        logger.warning("h2 library not installed, falling back to HTTP/1.1 keep-alive.")
+        return False
+
+
+def _create_client() -> httpx.AsyncClient:
+    """Create a pooled client with keep-alive connections."""
+    limits = httpx.Limits(
+        max_connections=config.HH_MAX_CONNECTIONS,
+        max_keepalive_connections=config.HH_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=config.HH_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(config.HH_TIMEOUT, connect=config.HH_CONNECT_TIMEOUT)
+    return httpx.AsyncClient(
+        http2=_http2_available(),
+        limits=limits,
+        timeout=timeout,
+        headers={"User-Agent": config.HH_USER_AGENT},
+    )
+
+
+async def init_client():
+    """Open the shared HTTP client. Call once on application startup."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _create_client()
+        logger.info("HH client initialized")
+
+
+async def close_client():
+    """Close the shared HTTP client. Call once on application shutdown."""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+        logger.info("HH client closed")
+    _client = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    """Get the shared client, creating it lazily if init_client wasn't called."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _create_client()
+    return _client
+
+
+def _search_params(
     text: str = None,
     min_salary: int = None,
     experience: str = None,
     area: str = None,
-    schedule: str = None,
-    page: int = 0
-):
-    """
-    Fetches vacancies from HH.ru API with optional filters.
-    Docs: https://github.com/hhru/api/blob/master/docs/vacancies.md
-    
-    Experience values: noExperience, between1And3, between3And6, moreThan6
-    Schedule values: remote, fullDay, shift, flexible
-    """
-    url = "https://api.hh.ru/vacancies"
-    
+    schedule: str = None
+) -> dict:
+    """Search filters as HH request parameters, with config defaults applied."""
     # Use config defaults if not specified
     text = text or config.SEARCH_QUERY
     min_salary = min_salary if min_salary is not None else config.MIN_SALARY
-    experience = experience or config.EXPERIENCE
+    # ("" means "no filter", e.g. a chat that chose any experience)
+    experience = experience if experience is not None else config.EXPERIENCE
     area = area if area is not None else config.AREA
-    schedule = schedule or getattr(config, 'SCHEDULE', '')
+    schedule = schedule if schedule is not None else getattr(config, 'SCHEDULE', '')
     
     params = {
         "text": text,
         "order_by": "publication_time",
-        "per_page": 20,
-        "page": page, # Added page parameter
         "search_field": "name",
     }
     
@@ -53,34 +208,259 @@ async def get_vacancies(
     if schedule:
         params["schedule"] = schedule
     
-    async with httpx.AsyncClient() as client:
+    return params
+
+
+def search_key(**filters) -> tuple:
+    """Hashable key of a search (see search_page filters); equivalent searches share it."""
+    return _cache_key(_search_params(**filters))
+
+
+async def search_page(
+    text: str = None,
+    min_salary: int = None,
+    experience: str = None,
+    area: str = None,
+    schedule: str = None,
+    page: int = 0,
+    date_from: str = None,
+    per_page: int = 20,
+    raise_errors: bool = False
+) -> dict:
+    """
+    Fetches one page of vacancies from HH.ru API with optional filters.
+    Docs: https://github.com/hhru/api/blob/master/docs/vacancies.md
+    
+    Experience values: noExperience, between1And3, between3And6, moreThan6
+    Schedule values: remote, fullDay, shift, flexible
+    date_from: ISO 8601 timestamp, only vacancies published since then
+    per_page: page size, up to MAX_PER_PAGE
+    
+    Returns {"items": [Vacancy, ...], "page": n, "pages": n, "found": n}.
+    On error returns an empty page with pages=0, or raises with raise_errors=True.
+    """
+    params = _search_params(text, min_salary, experience, area, schedule)
+    params["per_page"] = min(per_page, MAX_PER_PAGE)
+    params["page"] = page
+    
+    # Incremental polling: only vacancies published since date_from
+    if date_from:
+        params["date_from"] = date_from
+    
+    try:
+        data = await _fetch_shared(params)
+        vacancies = list(data.get("items", []))
+        
+        # Additional client-side salary filtering (HH API isn't always precise)
+        min_salary = params.get("salary", 0)
+        if min_salary > 0:
+            vacancies = [v for v in vacancies if _salary_meets_minimum(v, min_salary)]
+        
+        return {
+            "items": vacancies,
+            "page": data.get("page", page),
+            "pages": data.get("pages", 0),
+            "found": data.get("found", 0),
+        }
+    except Exception as e:
+        logger.error(f"Error fetching vacancies: {e}")
+        if raise_errors:
+            raise
+        return {"items": [], "page": page, "pages": 0, "found": 0}
+
+
+def _cache_key(params: dict) -> tuple:
+    """Normalized request parameters, so equivalent searches share one entry."""
+    key = dict(params)
+    key["text"] = " ".join(str(key.get("text", "")).lower().split())
+    return tuple(sorted((k, str(v)) for k, v in key.items()))
+
+
+def _retry_after(response: httpx.Response):
+    """Parse Retry-After header (seconds or HTTP date). Returns seconds or None."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+async def _request(params: dict) -> dict:
+    """
+    Perform one HH search request through the global rate limiter.
+    
+    429 and 5xx responses and network errors are retried with exponential
+    backoff and jitter (or Retry-After, when HH sends it). A 429 also pauses
+    the limiter, so every other caller backs off too.
+    """
+    for attempt in range(config.HH_MAX_RETRIES + 1):
+        await _rate_limiter.acquire()
         try:
-            response = await client.get(url, params=params)
-            response.raise_for_status()
-            data = response.json()
-            vacancies = data.get("items", [])
-            
-            # Additional client-side salary filtering (HH API isn't always precise)
-            if min_salary > 0:
-                vacancies = [v for v in vacancies if _salary_meets_minimum(v, min_salary)]
-            
-            return vacancies
-        except Exception as e:
-            logger.error(f"Error fetching vacancies: {e}")
-            return []
+            async with _request_semaphore:
+                response = await _get_client().get(API_URL, params=params)
+        except httpx.TransportError as e:
+            if attempt >= config.HH_MAX_RETRIES:
+                raise
+            delay = backoff_delay(attempt, config.HH_BACKOFF_BASE, config.HH_BACKOFF_MAX)
+            logger.warning(f"HH request failed ({e!r}), retrying in {delay:.1f}s (attempt {attempt+1}/{config.HH_MAX_RETRIES})")
+            await asyncio.sleep(delay)
+            continue
+        
+        status = response.status_code
+        if (status == 429 or status >= 500) and attempt < config.HH_MAX_RETRIES:
+            delay = _retry_after(response)
+            if delay is None:
+                delay = backoff_delay(attempt, config.HH_BACKOFF_BASE, config.HH_BACKOFF_MAX)
+            if status == 429:
+                _rate_limiter.pause(delay)
+            logger.warning(f"HH API returned {status}, retrying in {delay:.1f}s (attempt {attempt+1}/{config.HH_MAX_RETRIES})")
+            await asyncio.sleep(delay)
+            continue
+        
+        response.raise_for_status()
+        return response.json()
+
+
+async def _load(params: dict) -> dict:
+    """Request a page and parse its items into Vacancy records (cached form)."""
+    data = await _request(params)
+    data["items"] = [Vacancy.from_api(item) for item in data.get("items", [])]
+    return data
 
 
-def _salary_meets_minimum(vacancy: dict, min_salary: int) -> bool:
+async def _fetch_shared(params: dict) -> dict:
+    """
+    Single-flight + short-TTL cache around _load.
+    
+    Concurrent identical searches await the same in-flight request, and repeats
+    within HH_CACHE_TTL_SECONDS are served from memory. Errors are not cached.
+    The request is cancelled when the last caller waiting for it is.
+    """
+    key = _cache_key(params)
+    data = _response_cache.get(key)
+    if data is not None:
+        return data
+    
+    shared = _in_flight.get(key)
+    if shared is None:
+        shared = _in_flight[key] = {"task": asyncio.create_task(_load(params)), "waiters": 0}
+        
+        def _done(t):
+            if _in_flight.get(key) is shared:
+                del _in_flight[key]
+            if not t.cancelled() and t.exception() is None:
+                _response_cache.set(key, t.result())
+        shared["task"].add_done_callback(_done)
+    
+    # Shield: one caller giving up must not cancel the request for the others
+    shared["waiters"] += 1
+    try:
+        return await asyncio.shield(shared["task"])
+    finally:
+        shared["waiters"] -= 1
+        if not shared["waiters"] and not shared["task"].done():
+            # Nobody is left waiting: drop the request (later callers start a new one)
+            if _in_flight.get(key) is shared:
+                del _in_flight[key]
+            shared["task"].cancel()
+
+
+def cache_stats() -> dict:
+    """Response cache counters (for logging)."""
+    return {**_response_cache.stats(), "in_flight": len(_in_flight)}
+
+
+async def iter_vacancies(limit: int = None, per_page: int = MAX_PER_PAGE, max_pages: int = None, **filters):
+    """
+    Streams vacancies across result pages, newest first.
+    
+    Uses the largest page size HH allows (smaller if `limit` is smaller) and stops
+    at the last page HH reports, after `limit` vacancies or after `max_pages` pages.
+    The next page is requested only when the caller has consumed the current one,
+    so breaking out early never fetches more. A page that fails (after retries)
+    raises instead of looking like the end of the results.
+    """
+    if limit is not None:
+        if limit <= 0:
+            return
+        per_page = min(per_page, limit)
+    per_page = max(1, min(per_page, MAX_PER_PAGE))
+    
+    yielded = 0
+    page = 0
+    while max_pages is None or page < max_pages:
+        result = await search_page(page=page, per_page=per_page, raise_errors=True, **filters)
+        for vacancy in result["items"]:
+            yield vacancy
+            yielded += 1
+            if limit is not None and yielded >= limit:
+                return
+        page += 1
+        if page >= result["pages"]:
+            return
+
+
+async def fetch_pages(pages, concurrency: int = None, **filters):
+    """
+    Fetches several pages concurrently and yields (page, vacancies) in page order.
+    
+    At most `concurrency` pages are requested ahead of the consumer (all HH calls
+    also share the global request budget). Iteration ends after the last page
+    reported by HH. Pages still in flight when the caller stops iterating are
+    cancelled, so wrap the generator in contextlib.aclosing() when breaking early.
+    """
+    concurrency = max(1, concurrency or config.HH_PAGE_CONCURRENCY)
+    page_iter = iter(pages)
+    in_flight = deque()
+    
+    def _fill():
+        while len(in_flight) < concurrency:
+            page = next(page_iter, None)
+            if page is None:
+                return
+            task = asyncio.create_task(search_page(page=page, **filters))
+            in_flight.append((page, task))
+    
+    try:
+        _fill()
+        while in_flight:
+            page, task = in_flight.popleft()
+            result = await task
+            _fill()
+            yield page, result["items"]
+            if page + 1 >= result["pages"]:
+                break  # Last page of results
+    finally:
+        for _, task in in_flight:
+            task.cancel()
+
+
+def parse_published_at(value: str):
+    """Parse HH 'published_at' (e.g. 2024-01-15T12:34:56+0300). Returns None if invalid."""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, PUBLISHED_AT_FORMAT)
+    except ValueError:
+        return None
+
+
+def _salary_meets_minimum(vacancy: Vacancy, min_salary: int) -> bool:
     """Check if vacancy salary meets minimum requirement."""
-    salary = vacancy.get("salary")
-    if not salary:
+    if not vacancy.has_salary:
         return False
     
-    sal_from = salary.get("from") or 0
-    sal_to = salary.get("to") or 0
+    sal_from = vacancy.salary_from or 0
+    sal_to = vacancy.salary_to or 0
     
     # If salary is in USD or EUR, multiply by approximate rate
-    currency = salary.get("currency", "RUR")
+    currency = vacancy.salary_currency or "RUR"
     multiplier = 1
     if currency == "USD":
         multiplier = 90
@@ -91,30 +471,27 @@ def _salary_meets_minimum(vacancy: dict, min_salary: int) -> bool:
     return max_salary >= min_salary
 
 
-def format_vacancy(vacancy: dict, ai_score: int = None, ai_reasoning: dict = None) -> str:
-    """Format a vacancy dict into a nice string for Telegram."""
-    title = vacancy.get("name", "No Title")
-    url = vacancy.get("alternate_url", "")
-    salary = vacancy.get("salary")
+def format_vacancy(vacancy: Vacancy, ai_score: int = None, ai_reasoning: dict = None, queries: list = None) -> str:
+    """Format a vacancy into a nice string for Telegram (queries: the searches that found it)."""
+    title = vacancy.name or "No Title"
+    url = vacancy.url
     
     salary_str = "💰 Зарплата не указана"
-    if salary:
-        _from = salary.get("from")
-        _to = salary.get("to")
-        currency = salary.get("currency", "")
-        
-        if _from and _to:
-            salary_str = f"💰 {_from:,} - {_to:,} {currency}".replace(",", " ")
-        elif _from:
-            salary_str = f"💰 от {_from:,} {currency}".replace(",", " ")
-        elif _to:
-            salary_str = f"💰 до {_to:,} {currency}".replace(",", " ")
+    _from = vacancy.salary_from
+    _to = vacancy.salary_to
+    currency = vacancy.salary_currency
+    if _from and _to:
+        salary_str = f"💰 {_from:,} - {_to:,} {currency}".replace(",", " ")
+    elif _from:
+        salary_str = f"💰 от {_from:,} {currency}".replace(",", " ")
+    elif _to:
+        salary_str = f"💰 до {_to:,} {currency}".replace(",", " ")
 
-    employer = vacancy.get("employer", {}).get("name", "Unknown Company")
-    area = vacancy.get("area", {}).get("name", "")
+    employer = vacancy.employer or "Unknown Company"
+    area = vacancy.area
     
     # Experience
-    exp = vacancy.get("experience", {}).get("name", "")
+    exp = vacancy.experience
     exp_str = f"📊 {exp}" if exp else ""
 
     lines = [
@@ -149,6 +526,9 @@ def format_vacancy(vacancy: dict, ai_score: int = None, ai_reasoning: dict = Non
             if ai_reasoning.get("verdict"):
                 lines.append(f"💬 <i>Вердикт:</i> {ai_reasoning['verdict']}")
     
+    if queries:
+        lines.append(f"\n🔎 <i>Запросы:</i> {html.escape(', '.join(queries))}")
+    
     lines.append(f"\n🔗 {url}")
     
     return "\n".join(lines)
@@ -1,14 +1,22 @@
 import logging
 import asyncio
+import contextlib
 import json
+from collections import Counter, defaultdict
+from datetime import timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, Message
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
-from telegram.error import BadRequest
+from telegram.error import BadRequest, Forbidden
 
 import config
 import storage
+from cache import TTLCache
 import hh_client
 import ai_filter
+import outbound
+import pipeline
+import relevance
+from ratelimit import backoff_delay
 
 # Logging setup
 logging.basicConfig(
@@ -16,18 +24,61 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Global variable to store chat_id (in a real app, use DB)
-# Global variable to store chat_id (in a real app, use DB)
-target_chat_id = config.TARGET_CHAT_ID
-target_thread_id = None # For topic support
+# Bounded cache of vacancy data for button callbacks: id -> hh_client.Vacancy.
+# Backed by storage, so older messages keep working after eviction or restart.
+vacancy_cache = TTLCache(config.VACANCY_CACHE_SIZE, ttl=config.VACANCY_CACHE_TTL_SECONDS)
 
-# In-memory cache for vacancy data (for button callbacks)
-vacancy_cache = {}
+# Vacancies taken on the first poll of a query (before it has a watermark)
+FIRST_POLL_LIMIT = 20
 
+# Page size the user-facing search depth is measured in ("N стр.")
+DEPTH_PAGE_SIZE = 20
 
-def build_vacancy_keyboard(vacancy_id: str) -> InlineKeyboardMarkup:
-    """Build inline keyboard for a vacancy."""
-    is_fav = storage.is_favorite(vacancy_id)
+
+def cache_vacancy(vacancy: hh_client.Vacancy):
+    """Remember a vacancy for its message buttons."""
+    vacancy_cache.set(vacancy.id, vacancy)
+    storage.save_vacancy(vacancy)
+
+
+def get_cached_vacancy(vacancy_id: str) -> hh_client.Vacancy:
+    """Get vacancy data for a button press: memory first, then the database."""
+    vacancy = vacancy_cache.get(vacancy_id)
+    if vacancy is None:
+        vacancy = storage.get_vacancy(vacancy_id)
+        if vacancy is not None:
+            vacancy_cache.set(vacancy_id, vacancy)
+    return vacancy
+
+
+def filter_unseen(chat_id: int, vacancies: list) -> list:
+    """Keep vacancies that were neither sent to nor hidden in the chat."""
+    unseen = set(storage.filter_unseen(chat_id, [vac.id for vac in vacancies if vac.id]))
+    return [vac for vac in vacancies if vac.id in unseen]
+
+
+def chat_queries(chat_settings: dict) -> list:
+    """Search queries of a chat: comma-separated in its settings, else the config ones."""
+    db_query = chat_settings.get("search_query")
+    if db_query:
+        return [q.strip() for q in db_query.split(",") if q.strip()]
+    return getattr(config, 'SEARCH_QUERIES', [config.SEARCH_QUERY])
+
+
+def search_filters(chat_settings: dict, query: str) -> dict:
+    """HH search filters (hh_client.search_page keywords) for one of a chat's queries."""
+    return {
+        "text": query,
+        "min_salary": chat_settings.get("min_salary") or 0,
+        "experience": chat_settings.get("experience") or "",
+        "area": chat_settings.get("area"),
+        "schedule": "remote" if chat_settings.get("remote_only") else "",
+    }
+
+
+def build_vacancy_keyboard(chat_id: int, vacancy_id: str) -> InlineKeyboardMarkup:
+    """Build inline keyboard for a vacancy sent to a chat."""
+    is_fav = storage.is_favorite(chat_id, vacancy_id)
     fav_text = "⭐ Убрать" if is_fav else "⭐ В избранное"
     
     keyboard = [
@@ -40,12 +91,25 @@ def build_vacancy_keyboard(vacancy_id: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 
+def register_chat(update: Update) -> tuple[int, int]:
+    """Subscribe the chat (and topic) the command came from. Returns (chat_id, thread_id)."""
+    chat_id = update.effective_chat.id
+    thread_id = update.effective_message.message_thread_id # Capture topic ID
+    settings = storage.get_chat_settings(chat_id)
+    if settings["thread_id"] != thread_id:
+        storage.update_chat_setting(chat_id, "thread_id", thread_id)
+    if not settings["active"]:
+        storage.update_chat_setting(chat_id, "active", True)
+    claimed = storage.claim_legacy_favorites(chat_id)
+    if claimed:
+        logger.info(f"Chat {chat_id} took over {claimed} favorites saved before per-chat favorites")
+    return chat_id, thread_id
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Sends a welcome message and saves the chat ID."""
-    global target_chat_id, target_thread_id
+    """Sends a welcome message and subscribes the chat."""
     chat = update.effective_chat
-    target_chat_id = chat.id
-    target_thread_id = update.effective_message.message_thread_id # Capture topic ID
+    chat_id, thread_id = register_chat(update)
     
     # Build settings info
     queries_str = ", ".join(getattr(config, 'SEARCH_QUERIES', [config.SEARCH_QUERY]))
@@ -79,52 +143,50 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"/stats — статистика"
     )
     await update.message.reply_html(msg)
-    logger.info(f"Target chat set to {target_chat_id}")
+    logger.info(f"Chat {chat_id} subscribed (thread {thread_id})")
 
     # Immediately check for vacancies
-    await check_vacancies(context)
+    await check_chat_vacancies(context, chat_id, thread_id, use_plan=False)
 
 
 async def jobs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Force check for new vacancies."""
-    global target_chat_id, target_thread_id
-    chat = update.effective_chat
-    target_chat_id = chat.id
-    target_thread_id = update.effective_message.message_thread_id
+    chat_id, thread_id = register_chat(update)
     
     msg = await update.message.reply_text("🔄 Проверяю вакансии...")
-    new_count = await check_vacancies(context, return_count=True)
+    new_count = await check_chat_vacancies(context, chat_id, thread_id, use_plan=False)
+    await drain_outbox_chat(context.bot, chat_id)
     
     if new_count == 0:
         # Show latest vacancies IF they haven't been sent yet
-        await msg.edit_text("🔍 Новых нет, ищу в пропущенных...")
-        shown = await show_latest_vacancies(context, limit=5, status_message=msg)
+        await outbound.edit_message_text(context.bot, chat_id, msg.message_id, "🔍 Новых нет, ищу в пропущенных...")
+        shown = await show_latest_vacancies(context, chat_id, thread_id, limit=5, status_message=msg)
         
         if shown == 0:
              # Only update checking message to "All sent" if we didn't find anything deep either
              # And ensure we don't overwrite a "Digging deeper" message if logic changes, 
              # but here we know we are done.
              try:
-                await msg.edit_text("✅ Все актуальные вакансии уже были отправлены. Отдыхайте! ☕")
+                await outbound.edit_message_text(
+                    context.bot, chat_id, msg.message_id, "✅ Все актуальные вакансии уже были отправлены. Отдыхайте! ☕"
+                )
              except Exception:
                 pass
         else:
             # If we shown vacancies, we might want to delete the status message or leave it as summary
             try:
-                await context.bot.send_message(
-                    chat_id=target_chat_id,
-                    message_thread_id=target_thread_id,
-                    text=f"👆 Найдено {shown} пропущенных вакансий"
+                await outbound.send_message(
+                    context.bot, chat_id, f"👆 Найдено {shown} пропущенных вакансий", message_thread_id=thread_id
                 )
             except Exception:
                 pass
     else:
-        await msg.edit_text(f"✅ Найдено {new_count} новых вакансий!")
+        await outbound.edit_message_text(context.bot, chat_id, msg.message_id, f"✅ Найдено {new_count} новых вакансий!")
 
 
 async def favorites(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show saved favorites."""
-    favs = storage.get_favorites()
+    favs = storage.get_favorites(update.effective_chat.id)
     
     if not favs:
         await update.message.reply_text("⭐ У вас пока нет избранных вакансий.")
@@ -144,13 +206,14 @@ async def favorites(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show bot statistics and analytics."""
     weekly = storage.get_weekly_stats()
-    total_sent = storage.get_total_sent_count()
-    favorites_count = storage.get_favorites_count()
+    total_sent = storage.get_total_sent_count(update.effective_chat.id)
+    favorites_count = storage.get_favorites_count(update.effective_chat.id)
     
     lines = [
         "📊 <b>Статистика бота</b>\n",
         f"📈 Всего отправлено: {total_sent}",
         f"⭐ В избранном: {favorites_count}",
+        f"🧹 AI-оценок сэкономлено фильтром: {relevance.llm_calls_saved()}",
         "",
         "<b>За последние 7 дней:</b>",
         f"📋 Новых вакансий: {weekly['total_vacancies']}",
@@ -243,187 +306,480 @@ async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_html(msg, reply_markup=keyboard)
 
 
-async def show_latest_vacancies(context: ContextTypes.DEFAULT_TYPE, limit: int = 5, status_message: Message = None) -> int:
+async def show_latest_vacancies(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    thread_id: int = None,
+    limit: int = 5,
+    status_message: Message = None
+) -> int:
     """Show latest unsent vacancies, checking deeper pages if needed."""
-    global target_chat_id, target_thread_id
-    if not target_chat_id:
-        return 0
-        
+    async with _chat_lock(chat_id):
+        return await _show_latest_vacancies(context, chat_id, thread_id, limit, status_message)
+
+
+async def _show_latest_vacancies(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    thread_id: int,
+    limit: int,
+    status_message: Message
+) -> int:
     shown = 0
+    sent_ids = set()  # Ids queued for delivery in this call
     
-    # Iterate over all search queries
-    # First try to get from DB, if split by comma
-    db_query = storage.get_chat_settings(target_chat_id).get("search_query")
-    if db_query:
-        queries = [q.strip() for q in db_query.split(",") if q.strip()]
-    else:
-        queries = getattr(config, 'SEARCH_QUERIES', [config.SEARCH_QUERY])
+    chat_settings = storage.get_chat_settings(chat_id)
+    queries = chat_queries(chat_settings)
+    
+    # Get search depth from settings (default 1)
+    search_depth = chat_settings.get("search_depth", 1)
     
-    for query in queries:
-        if shown >= limit:
-            break
+    try:
+        for query in queries:
+            if shown >= limit:
+                break
             
-        # Get search depth from settings (default 1)
-        depth = storage.get_chat_settings(target_chat_id).get("search_depth", 1)
+            filters = search_filters(chat_settings, query)
+            depth = search_depth
         
-        # Prepare list of NOT sent vacancies by iterating pages
-        not_sent_vacancies = []
+            # Prepare list of NOT sent vacancies by iterating pages
+            not_sent_vacancies = []
         
-        # Always check page 0 first
-        vacancies = await hh_client.get_vacancies(text=query, page=0)
-        for vac in vacancies:
-            vac_id = vac.get("id")
-            if vac_id and not storage.is_sent(vac_id) and not storage.is_hidden(vac_id):
-                not_sent_vacancies.append(vac)
-
-        # If page 0 empty and depth > 1, check deeper pages
-        if not not_sent_vacancies and depth > 1:
-            if status_message:
-                await status_message.edit_text(f"🔎 Новых нет, копаю глубже (до {depth} стр)...")
-            else:
-                await context.bot.send_message(
-                    chat_id=target_chat_id, 
-                    message_thread_id=target_thread_id,
-                    text=f"🔎 Новых нет, копаю глубже (до {depth} стр)..."
-                )
-            
-            for page in range(1, depth):
+            # Always check page 0 first
+            first_page = await hh_client.search_page(page=0, per_page=DEPTH_PAGE_SIZE, **filters)
+            not_sent_vacancies.extend(filter_unseen(chat_id, first_page["items"]))
+
+            # Don't dig past the last page HH has for this query
+            depth = min(depth, first_page["pages"])
+
+            # If page 0 empty and depth > 1, check deeper pages
+            if not not_sent_vacancies and depth > 1:
                 if status_message:
-                    try:
-                         # Only update if text changes to avoid errors
-                        await status_message.edit_text(f"🔎 Проверяю страницу {page+1} из {depth}...") 
-                    except Exception:
-                         pass
-
-                # Stop if we found enough vacancies or hit limit
-                if len(not_sent_vacancies) >= limit:
-                    break
-                    
-                p_vacs = await hh_client.get_vacancies(text=query, page=page)
-                if not p_vacs:
-                    break # End of results
+                    await outbound.edit_message_text(
+                        context.bot, chat_id, status_message.message_id, f"🔎 Новых нет, копаю глубже (до {depth} стр)..."
+                    )
+                else:
+                    await outbound.send_message(
+                        context.bot, chat_id, f"🔎 Новых нет, копаю глубже (до {depth} стр)...", message_thread_id=thread_id
+                    )
+            
+                # Deeper results are fetched in bulk pages, concurrently; leaving the loop cancels the rest
+                seen_ids = {vac.id for vac in first_page["items"]}
+                max_items = depth * DEPTH_PAGE_SIZE
+                per_page = hh_client.MAX_PER_PAGE
+                bulk_pages = -(-max_items // per_page)
+                pages = hh_client.fetch_pages(range(bulk_pages), per_page=per_page, **filters)
+                async with contextlib.aclosing(pages):
+                    async for page, p_vacs in pages:
+                        if status_message:
+                            try:
+                                 # Only update if text changes to avoid errors
+                                await outbound.edit_message_text(
+                                    context.bot, chat_id, status_message.message_id,
+                                    f"🔎 Проверяю вакансии {page * per_page + 1}-{min((page + 1) * per_page, max_items)}..."
+                                )
+                            except Exception:
+                                 pass
+                        
+                        p_vacs = [vac for vac in p_vacs[:max_items - page * per_page] if vac.id not in seen_ids]
+                        not_sent_vacancies.extend(filter_unseen(chat_id, p_vacs))
                     
-                for vac in p_vacs:
-                    vac_id = vac.get("id")
-                    if vac_id and not storage.is_sent(vac_id) and not storage.is_hidden(vac_id):
-                        not_sent_vacancies.append(vac)
-                
-                # Small delay to respect API limits
-                await asyncio.sleep(0.3)
+                        # Stop if we found enough vacancies
+                        if len(not_sent_vacancies) >= limit:
+                            break
         
-        # If we have unsent vacancies, show them
-        if not_sent_vacancies:
-            for vac in not_sent_vacancies[:limit - shown]:
-                vac_id = vac.get("id")
+            # If we have unsent vacancies, show them
+            if not_sent_vacancies:
+                # Skip vacancies already shown under another query
+                candidates = [vac for vac in not_sent_vacancies[:limit - shown] if vac.id not in sent_ids]
                 
-                # AI Scoring
-                ai_score = -1
-                ai_reasoning = None
-                if config.AI_FILTER_ENABLED:
-                    ai_score, ai_reasoning = await ai_filter.score_vacancy(vac, {"search_query": query})
-                    # Pause to respect Gemini free tier rate limits (RPM is low)
-                    await asyncio.sleep(4)
+                # AI Scoring, in concurrent batches paced by ai_filter's provider limits
+                scores = {}
+                if config.AI_FILTER_ENABLED and candidates:
+                    scores = await ai_filter.score_vacancies(
+                        candidates, {"search_query": query, "resume_text": chat_settings.get("resume_text")}
+                    )
                 
-                # Cache for buttons
-                vacancy_cache[vac_id] = vac
+                for vac in candidates:
+                    vac_id = vac.id
                 
-                text = hh_client.format_vacancy(vac, ai_score=ai_score if ai_score >= 0 else None, ai_reasoning=ai_reasoning)
-                keyboard = build_vacancy_keyboard(vac_id)
+                    ai_score = -1
+                    ai_reasoning = None
+                    if config.AI_FILTER_ENABLED:
+                        ai_score, ai_reasoning = scores[vac_id]
                 
-                try:
-                    await context.bot.send_message(
-                        chat_id=target_chat_id,
-                        message_thread_id=target_thread_id,
-                        text=text,
-                        parse_mode="HTML",
-                        reply_markup=keyboard
-                    )
-                    storage.mark_sent(vac_id) # Mark as sent now
+                    queue_vacancy(chat_id, thread_id, vac, ai_score, ai_reasoning)
+                    sent_ids.add(vac_id)
                     shown += 1
-                    await asyncio.sleep(0.5)
-                except Exception as e:
-                    logger.error(f"Failed to send: {e}")
-            if shown >= limit:
-                break
-        else:
-            continue
+                if shown >= limit:
+                    break
+    finally:
+        # Deliver what was queued now, so it arrives before the /jobs summary
+        await drain_outbox_chat(context.bot, chat_id)
     
     return shown
 
 
+# Fetch plan of the current polling cycle: search key -> {"filters", "chats", "task"}.
+# Chats watching the same search share one HH fetch per cycle ("chats" maps chat_id -> query).
+# A chat checked late in the cycle misses what was published after the fetch, but its
+# watermark only moves to what it got, so the next cycle picks the rest up.
+_fetch_plan = {}
 
-async def check_vacancies(context: ContextTypes.DEFAULT_TYPE, return_count: bool = False):
-    """Background task to check for new vacancies."""
-    global target_chat_id, target_thread_id
-    if not target_chat_id:
-        logger.warning("No target chat set yet. Waiting for /start command.")
-        return 0 if return_count else None
 
-    logger.info("Checking for new vacancies...")
+def build_fetch_plan(chat_ids: list) -> dict:
+    """Group the chats' queries by normalized search, so each distinct search is fetched once."""
+    plan = {}
+    for chat_id in chat_ids:
+        chat_settings = storage.get_chat_settings(chat_id)
+        for query in chat_queries(chat_settings):
+            filters = search_filters(chat_settings, query)
+            entry = plan.setdefault(
+                hh_client.search_key(**filters), {"filters": filters, "chats": {}, "task": None}
+            )
+            entry["chats"][chat_id] = query
+    return plan
+
+
+async def _fetch_since(filters: dict, watermark) -> list:
+    """Newest FIRST_POLL_LIMIT vacancies without a watermark, else all published since it."""
+    if not watermark:
+        return [vac async for vac in hh_client.iter_vacancies(limit=FIRST_POLL_LIMIT, **filters)]
     
-    # Iterate over all search queries
-    # First try to get from DB, if split by comma
-    db_query = storage.get_chat_settings(target_chat_id).get("search_query")
-    if db_query:
-        queries = [q.strip() for q in db_query.split(",") if q.strip()]
-    else:
-        queries = getattr(config, 'SEARCH_QUERIES', [config.SEARCH_QUERY])
+    date_from = (watermark - timedelta(minutes=config.POLL_OVERLAP_MINUTES)).strftime(hh_client.PUBLISHED_AT_FORMAT)
+    return [
+        vac async for vac in hh_client.iter_vacancies(
+            date_from=date_from, max_pages=config.POLL_MAX_PAGES, **filters
+        )
+    ]
+
+
+async def _fetch_for_plan(entry: dict) -> list:
+    """One fetch covering every chat of a plan entry: since the oldest of their watermarks."""
+    watermarks = [
+        hh_client.parse_published_at(storage.get_watermark(chat_id, query))
+        for chat_id, query in entry["chats"].items()
+    ]
+    # Results are newest first, so chats without a watermark still get their first page
+    return await _fetch_since(entry["filters"], min(filter(None, watermarks), default=None))
+
+
+def _plan_task(entry: dict) -> asyncio.Future:
+    """The entry's shared fetch for this cycle, restarted if it failed."""
+    task = entry["task"]
+    if task is not None and task.done() and (task.cancelled() or task.exception()):
+        task = None
+    if task is None:
+        task = entry["task"] = asyncio.ensure_future(_fetch_for_plan(entry))
+    return task
+
+
+async def fetch_new_vacancies(chat_id: int, query: str, filters: dict, use_plan: bool = True) -> list:
+    """
+    Fetch vacancies published since the previous cycle for a chat's query.
     
-    new_count = 0
-    for query in queries:
-        vacancies = await hh_client.get_vacancies(text=query)
-        
-        for vac in reversed(vacancies):
-            vac_id = vac.get("id")
-            if not vac_id:
-                continue
+    First run (no watermark yet) takes only the newest page. After that HH's
+    date_from is used and pages are followed until we are caught up. Searches
+    in the cycle's fetch plan are fetched once per cycle and trimmed per chat;
+    use_plan=False (manual checks) always fetches afresh.
+    """
+    watermark = hh_client.parse_published_at(storage.get_watermark(chat_id, query))
+    entry = _fetch_plan.get(hh_client.search_key(**filters)) if use_plan else None
+    if entry is None or chat_id not in entry["chats"]:
+        return await _fetch_since(filters, watermark)
+    
+    # Cancelling one chat's check must not cancel a fetch other chats wait for
+    vacancies = await asyncio.shield(_plan_task(entry))
+    
+    if not watermark:
+        return vacancies[:FIRST_POLL_LIMIT]
+    since = watermark - timedelta(minutes=config.POLL_OVERLAP_MINUTES)
+    return [
+        vac for vac in vacancies
+        if (published_at := hh_client.parse_published_at(vac.published_at)) is None or published_at >= since
+    ]
+
+
+def record_delivery_stats(sent: list, matched: dict):
+    """Add the cycle's sent vacancies to the daily stats of every query that found them (/stats)."""
+    delivered = defaultdict(list)
+    for vac in sent:
+        for query in matched[vac.id]:
+            delivered[query].append(vac)
+    
+    for query, vacancies in delivered.items():
+        salaries = [
+            vac.salary_from or vac.salary_to for vac in vacancies
+            if vac.salary_currency == "RUR" and (vac.salary_from or vac.salary_to)
+        ]
+        avg_salary = sum(salaries) // len(salaries) if salaries else 0
+        employers = Counter(vac.employer for vac in vacancies if vac.employer).most_common(1)
+        storage.record_vacancy_stats(query, len(vacancies), avg_salary, employers[0][0] if employers else "")
+
+
+# ============ Outbox delivery ============
+
+# Set when messages are queued, so the outbox worker delivers them right away
+_outbox_wakeup = asyncio.Event()
+_outbox_locks = {}
+_outbox_task = None
+
+
+def queue_vacancy(chat_id: int, thread_id: int, vac: hh_client.Vacancy, ai_score: int, ai_reasoning: dict,
+                  queries: list = None) -> bool:
+    """Render a vacancy message into the outbox (marking it sent). False if it was already queued."""
+    # Cache vacancy for button callbacks
+    cache_vacancy(vac)
+    
+    # Format message with AI score if available
+    text = hh_client.format_vacancy(
+        vac, ai_score=ai_score if ai_score >= 0 else None, ai_reasoning=ai_reasoning, queries=queries
+    )
+    keyboard = build_vacancy_keyboard(chat_id, vac.id)
+    queued = storage.enqueue_outbox(chat_id, thread_id, vac.id, text, keyboard.to_json())
+    _outbox_wakeup.set()
+    return queued
+
+
+async def drain_outbox_chat(bot, chat_id: int) -> int:
+    """
+    Deliver a chat's due queued messages in order. Returns number delivered.
+    A failed message waits out a backoff (from OUTBOX_POLL_SECONDS, doubling)
+    before it is tried again, however often the outbox is woken up meanwhile.
+    
+    A message is marked delivered right after Telegram accepts it. Telegram has
+    no idempotent send, so a message can arrive twice: when a crash comes
+    between the send and the mark, or when a send times out after Telegram got
+    it and the next pass sends it again. A message is dropped when Telegram
+    rejects it, when the chat is gone, or after OUTBOX_MAX_ATTEMPTS failures.
+    """
+    lock = _outbox_locks.setdefault(chat_id, asyncio.Lock())
+    delivered = 0
+    async with lock:
+        while True:
+            messages = storage.get_pending_outbox(chat_id)
+            if not messages:
+                return delivered
             
-            # Skip hidden vacancies
-            if storage.is_hidden(vac_id):
-                continue
-                
-            if not storage.is_sent(vac_id):
-                # AI Filtering
-                ai_score = -1
-                ai_reasoning = None
-                if config.AI_FILTER_ENABLED:
-                    ai_score, ai_reasoning = await ai_filter.score_vacancy(vac, {"search_query": query})
-                    # Pause to respect Gemini free tier rate limits
-                    await asyncio.sleep(4)
-                    
-                    if not ai_filter.should_send_vacancy(ai_score):
-                        logger.info(f"Skipping vacancy (AI score: {ai_score}): {vac.get('name')}")
-                        storage.mark_sent(vac_id)  # Mark as sent so we don't re-check
-                        continue
-                
-                # Cache vacancy for button callbacks
-                vacancy_cache[vac_id] = vac
-                
-                # Format message with AI score if available
-                text = hh_client.format_vacancy(vac, ai_score=ai_score if ai_score >= 0 else None, ai_reasoning=ai_reasoning)
-                keyboard = build_vacancy_keyboard(vac_id)
-                
+            for message in messages:
                 try:
-                    await context.bot.send_message(
-                        chat_id=target_chat_id, 
-                        message_thread_id=target_thread_id,
-                        text=text, 
+                    await outbound.send_message(
+                        bot, chat_id, message["text"],
+                        message_thread_id=message["thread_id"],
                         parse_mode="HTML",
-                        reply_markup=keyboard
+                        reply_markup=InlineKeyboardMarkup.de_json(json.loads(message["keyboard"]), bot)
                     )
-                    storage.mark_sent(vac_id)
-                    new_count += 1
-                    await asyncio.sleep(1)
+                except Forbidden as e:
+                    # Bot was removed from the chat: stop serving it until the next /start
+                    dropped = storage.drop_outbox(chat_id)
+                    storage.update_chat_setting(chat_id, "active", False)
+                    logger.warning(f"Chat {chat_id} unavailable ({e}), unsubscribed and dropped {dropped} messages")
+                    return delivered
+                except BadRequest as e:
+                    logger.error(f"Telegram rejected vacancy {message['vacancy_id']} for chat {chat_id}: {e}")
+                    storage.mark_outbox_failed(message["id"], max_attempts=1)
+                    continue
                 except Exception as e:
-                    logger.error(f"Failed to send message: {e}")
+                    # Back off from OUTBOX_POLL_SECONDS up, doubling per attempt
+                    retry_in = backoff_delay(message["attempts"], 2 * config.OUTBOX_POLL_SECONDS, 3600)
+                    gave_up = storage.mark_outbox_failed(message["id"], config.OUTBOX_MAX_ATTEMPTS, retry_in)
+                    logger.error(
+                        f"Failed to deliver vacancy {message['vacancy_id']} to chat {chat_id}: {e}"
+                        + (" (giving up)" if gave_up else " (will retry)")
+                    )
+                    return delivered  # Keep the order: retry from here on the next pass
+                
+                storage.mark_outbox_delivered(message["id"])
+                delivered += 1
+
+
+async def outbox_worker(bot):
+    """Background task: deliver queued messages, on wakeup or every OUTBOX_POLL_SECONDS."""
+    while True:
+        _outbox_wakeup.clear()
+        try:
+            chat_ids = storage.get_outbox_chat_ids()
+            await asyncio.gather(*(drain_outbox_chat(bot, chat_id) for chat_id in chat_ids))
+        except Exception as e:
+            logger.error(f"Outbox delivery failed: {e}")
+        
+        try:
+            await asyncio.wait_for(_outbox_wakeup.wait(), config.OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+# Per-chat locks: a scheduled check and /jobs must not deliver to the same chat at once
+_chat_locks = {}
+
+
+def _chat_lock(chat_id: int) -> asyncio.Lock:
+    return _chat_locks.setdefault(chat_id, asyncio.Lock())
+
+
+async def schedule_checks(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Polling cycle: queue a check for every subscribed chat, spread evenly across
+    the check interval so HH and Telegram get a steady load instead of a burst.
+    Chats sharing a search get adjacent slots, so the shared fetch is fresh for all.
+    """
+    chat_ids = storage.get_active_chat_ids()
+    if not chat_ids:
+        logger.warning("No subscribed chats yet. Waiting for /start command.")
+        return
+    
+    global _fetch_plan
+    _fetch_plan = build_fetch_plan(chat_ids)
+    logger.info(f"Fetch plan: {len(_fetch_plan)} distinct searches for {len(chat_ids)} chats")
+    
+    grouped = [chat_id for entry in _fetch_plan.values() for chat_id in entry["chats"]]
+    chat_ids = list(dict.fromkeys(grouped + chat_ids))
+    
+    step = config.CHECK_INTERVAL_SECONDS / len(chat_ids)
+    for i, chat_id in enumerate(chat_ids):
+        context.job_queue.run_once(check_chat_job, when=i * step, data=chat_id, name=f"check:{chat_id}")
+    logger.info(f"Scheduled checks for {len(chat_ids)} chats, {step:.0f}s apart")
+
+
+async def prune_storage(context: ContextTypes.DEFAULT_TYPE):
+    """Job callback: drop stored vacancies, delivered outbox messages and AI scores past their age."""
+    removed = storage.prune_vacancies(config.VACANCY_STORE_DAYS)
+    if removed:
+        logger.info(f"Pruned {removed} stored vacancies older than {config.VACANCY_STORE_DAYS} days")
+    removed = storage.prune_outbox(config.VACANCY_STORE_DAYS)
+    if removed:
+        logger.info(f"Pruned {removed} delivered outbox messages older than {config.VACANCY_STORE_DAYS} days")
+    removed = storage.prune_ai_scores(config.AI_SCORE_CACHE_DAYS)
+    if removed:
+        logger.info(f"Pruned {removed} cached AI scores older than {config.AI_SCORE_CACHE_DAYS} days")
+
+
+async def check_chat_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job callback: scheduled check of one chat."""
+    chat_id = context.job.data
+    chat_settings = storage.get_chat_settings(chat_id)
+    if not chat_settings["active"]:
+        return
+    if _chat_lock(chat_id).locked():
+        logger.info(f"Chat {chat_id} is still being checked, skipping this slot")
+        return
+    await check_chat_vacancies(context, chat_id, chat_settings["thread_id"])
+
+
+async def check_chat_vacancies(context: ContextTypes.DEFAULT_TYPE, chat_id: int, thread_id: int = None,
+                               use_plan: bool = True) -> int:
+    """
+    Check one chat's queries for new vacancies and send them. Returns number sent.
+    Manual checks pass use_plan=False to fetch afresh instead of sharing the cycle's fetches.
+    """
+    async with _chat_lock(chat_id):
+        return await _check_chat_vacancies(context, chat_id, thread_id, use_plan)
+
+
+async def _check_chat_vacancies(context: ContextTypes.DEFAULT_TYPE, chat_id: int, thread_id: int = None,
+                                use_plan: bool = True) -> int:
+    logger.info(f"Checking for new vacancies for chat {chat_id}...")
+    
+    chat_settings = storage.get_chat_settings(chat_id)
+    queries = chat_queries(chat_settings)
+    
+    new_count = 0
+    # Vacancies to send are queued in the outbox (and marked sent) one by one and
+    # delivered by the outbox worker. Ids rejected by AI and the new per-query
+    # watermarks are flushed together at the end of the cycle.
+    rejected_ids = set()
+    watermarks = {}
+    matched = {}  # vacancy id -> queries that found it this cycle (scored and sent once)
+    newest = {}  # query -> newest publication fetched
+    sent = []  # Vacancies queued, for stats
+    
+    # Pipeline: fetch -> dedupe -> score -> queue, connected by bounded queues,
+    # so fetching the next query overlaps scoring and queueing of the current one
+    # (the outbox worker sends in parallel)
+    fetched = asyncio.Queue(config.PIPELINE_QUEUE_SIZE)  # (query, vacancies)
+    to_score = asyncio.Queue(config.PIPELINE_QUEUE_SIZE)  # (query, new vacancies)
+    to_queue = asyncio.Queue(config.PIPELINE_QUEUE_SIZE)  # (vacancy, ai_score, ai_reasoning)
+    
+    async def fetch(query: str) -> list:
+        try:
+            vacancies = await fetch_new_vacancies(chat_id, query, search_filters(chat_settings, query), use_plan)
+        except Exception as e:
+            # Incomplete fetch: the query's watermark stays put, so the next cycle catches up from it
+            logger.error(f"Fetching '{query}' for chat {chat_id} failed, retrying next cycle: {e}")
+            return []
+        return [(query, vacancies)]
+    
+    async def dedupe(item: tuple) -> list:
+        query, vacancies = item
+        newest_at = max(filter(None, (hh_client.parse_published_at(v.published_at) for v in vacancies)), default=None)
+        if newest_at:
+            newest[query] = newest_at
+        
+        fresh = []
+        for vac in reversed(filter_unseen(chat_id, vacancies)):
+            if vac.id in matched:
+                if query not in matched[vac.id]:
+                    matched[vac.id].append(query)  # Already on its way under another query
+                continue
+            matched[vac.id] = [query]
+            fresh.append(vac)
+        return [(query, fresh)] if fresh else []
+    
+    async def score(item: tuple) -> list:
+        query, vacancies = item
+        if not config.AI_FILTER_ENABLED:
+            return [(vac, -1, None) for vac in vacancies]
+        
+        # Concurrent batches paced by ai_filter's provider limits
+        scores = await ai_filter.score_vacancies(
+            vacancies, {"search_query": query, "resume_text": chat_settings.get("resume_text")}
+        )
+        return [(vac, *scores[vac.id]) for vac in vacancies]
+    
+    async def enqueue(item: tuple):
+        nonlocal new_count
+        vac, ai_score, ai_reasoning = item
+        if ai_score == ai_filter.KEYWORD_MISS:
+            # Not marked sent: a keyword miss is a guess, the vacancy may still show up in /jobs
+            logger.info(f"Skipping vacancy (no query keywords): {vac.name}")
+            return
+        if config.AI_FILTER_ENABLED and not ai_filter.should_send_vacancy(ai_score):
+            logger.info(f"Skipping vacancy (AI score: {ai_score}): {vac.name}")
+            rejected_ids.add(vac.id)  # Mark as sent so we don't re-check
+            return
+        
+        # The message lists the queries that found it so far
+        found_by = matched[vac.id] if len(queries) > 1 else None
+        if queue_vacancy(chat_id, thread_id, vac, ai_score, ai_reasoning, queries=found_by):
+            sent.append(vac)
+            new_count += 1
+    
+    try:
+        await pipeline.run(
+            pipeline.stage(pipeline.feed(queries), fetch, fetched, config.PIPELINE_FETCH_CONCURRENCY),
+            pipeline.stage(fetched, dedupe, to_score),
+            pipeline.stage(to_score, score, to_queue, config.PIPELINE_SCORE_CONCURRENCY),
+            pipeline.stage(to_queue, enqueue),
+        )
+        
+        # Everything fetched is now queued or rejected, so watermarks can advance
+        for query, newest_at in newest.items():
+            watermarks[query] = newest_at.strftime(hh_client.PUBLISHED_AT_FORMAT)
+    finally:
+        storage.mark_sent_many(chat_id, rejected_ids)
+        for query, published_at in watermarks.items():
+            storage.set_watermark(chat_id, query, published_at)
+        record_delivery_stats(sent, matched)
 
     if new_count > 0:
-        logger.info(f"Sent {new_count} new vacancies.")
+        logger.info(f"Queued {new_count} new vacancies for chat {chat_id}.")
     else:
-        logger.info("No new vacancies found.")
+        logger.info(f"No new vacancies found for chat {chat_id}.")
+    logger.info(f"Vacancy cache: {vacancy_cache.stats()}")
+    logger.info(f"HH response cache: {hh_client.cache_stats()}")
+    logger.info(f"Relevance pre-filter: {relevance.stats()}")
     
-    if return_count:
-        return new_count
+    return new_count
 
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -445,22 +801,22 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # ============ Vacancy Actions ============
     if action == "fav":
         # Toggle favorite
-        if storage.is_favorite(value):
-            storage.remove_favorite(value)
+        if storage.is_favorite(chat_id, value):
+            storage.remove_favorite(chat_id, value)
             await query.answer("❌ Убрано из избранного")
         else:
-            vacancy = vacancy_cache.get(value, {"id": value})
-            storage.add_favorite(vacancy)
+            vacancy = get_cached_vacancy(value) or hh_client.Vacancy(id=value)
+            storage.add_favorite(chat_id, vacancy)
             await query.answer("⭐ Добавлено в избранное!")
         
         try:
-            new_keyboard = build_vacancy_keyboard(value)
+            new_keyboard = build_vacancy_keyboard(chat_id, value)
             await query.edit_message_reply_markup(reply_markup=new_keyboard)
         except BadRequest:
             pass
     
     elif action == "hide":
-        storage.hide_vacancy(value)
+        storage.hide_vacancy(chat_id, value)
         await query.answer("🙈 Вакансия скрыта")
         try:
             await query.edit_message_text(text="<i>🙈 Вакансия скрыта</i>", parse_mode="HTML")
@@ -479,9 +835,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("✍️ Пишу письмо...")
         
         # Get vacancy data
-        vac_data = vacancy_cache.get(vac_id)
+        vac_data = get_cached_vacancy(vac_id)
         if not vac_data:
-            # Try to fetch if not in cache (simplified, ideally re-fetch)
             await query.answer("⚠️ Данные вакансии устарели", show_alert=True)
             return
 
@@ -538,7 +893,6 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except ValueError:
                 new_depth = 1
                 
-            storage.update_chat_setting(chat_id, "search_depth", new_depth)
             storage.update_chat_setting(chat_id, "search_depth", new_depth)
             await settings(update, context) # Refresh setting menu
 
@@ -697,10 +1051,16 @@ def main():
 
     # Job queue for periodic checks
     job_queue = application.job_queue
-    job_queue.run_repeating(check_vacancies, interval=config.CHECK_INTERVAL_SECONDS, first=10)
+    job_queue.run_repeating(schedule_checks, interval=config.CHECK_INTERVAL_SECONDS, first=10)
+    job_queue.run_repeating(prune_storage, interval=config.PRUNE_INTERVAL_SECONDS, first=0)
 
     # Register command menu
     async def post_init(app):
+        global _outbox_task
+        await hh_client.init_client()
+        # Messages left queued by a previous run go out first
+        _outbox_task = asyncio.create_task(outbox_worker(app.bot))
+
         commands = [
             BotCommand("start", "Показать информацию"),
             BotCommand("jobs", "Проверить вакансии"),
@@ -711,7 +1071,16 @@ def main():
         await app.bot.set_my_commands(commands)
         logger.info("Bot commands menu registered")
     
+    async def post_shutdown(app):
+        if _outbox_task:
+            _outbox_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await _outbox_task
+        await hh_client.close_client()
+        storage.close_db()
+
     application.post_init = post_init
+    application.post_shutdown = post_shutdown
 
     logger.info("Bot started...")
     # Allow groups - bot needs to be added with privacy mode disabled
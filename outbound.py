@@ -0,0 +1,90 @@
+"""
+Outbound Telegram traffic: one place that paces sends and edits to Telegram's
+flood limits and retries flood-wait and network errors.
+"""
+
+import asyncio
+import logging
+from datetime import timedelta
+
+import httpx
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+import config
+from ratelimit import TokenBucket, backoff_delay
+
+logger = logging.getLogger(__name__)
+
+# Whole bot: ~30 messages per second
+_global_limiter = TokenBucket(config.TG_GLOBAL_RATE, burst=config.TG_GLOBAL_RATE)
+
+# Per chat: a FIFO lock (asyncio wakes waiters in order) and its rate limiters
+_chats = {}
+
+
+def _chat(chat_id: int) -> tuple:
+    state = _chats.get(chat_id)
+    if state is None:
+        limiters = [TokenBucket(config.TG_CHAT_RATE, burst=1)]
+        if chat_id < 0:  # Groups and channels: also ~20 messages per minute
+            limiters.append(TokenBucket(config.TG_GROUP_PER_MINUTE / 60, burst=config.TG_GROUP_PER_MINUTE))
+        state = _chats[chat_id] = (asyncio.Lock(), limiters)
+    return state
+
+
+def _not_sent(error: NetworkError) -> bool:
+    """Whether a network error happened before the request went out (PTB chains the httpx error)."""
+    return isinstance(error.__cause__, (httpx.PoolTimeout, httpx.ConnectError, httpx.ConnectTimeout))
+
+
+def _seconds(retry_after) -> float:
+    """RetryAfter.retry_after is int seconds or a timedelta, depending on the PTB version."""
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+async def call(chat_id: int, method, /, *args, idempotent: bool = True, **kwargs):
+    """
+    Run a Telegram API call aimed at a chat, in order with the chat's other calls
+    and within the global and per-chat limits. RetryAfter is waited out and
+    network errors are retried with backoff, up to TG_MAX_RETRIES times; other
+    errors are raised to the caller.
+    
+    A timeout or dropped connection may come after Telegram got the request, so
+    non-idempotent calls (sends) only retry errors raised before it went out.
+    """
+    lock, limiters = _chat(chat_id)
+    async with lock:
+        for attempt in range(config.TG_MAX_RETRIES + 1):
+            for limiter in limiters:
+                await limiter.acquire()
+            await _global_limiter.acquire()
+
+            try:
+                return await method(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= config.TG_MAX_RETRIES:
+                    raise
+                delay = _seconds(e.retry_after)
+                logger.warning(f"Telegram flood limit for chat {chat_id}, retrying in {delay:.0f}s")
+                for limiter in limiters:
+                    limiter.pause(delay)
+            except BadRequest:
+                raise  # A NetworkError subclass, but retrying won't help
+            except NetworkError as e:
+                if attempt >= config.TG_MAX_RETRIES or not (idempotent or _not_sent(e)):
+                    raise
+                delay = backoff_delay(attempt, 1, 30)
+                logger.warning(f"Telegram network error for chat {chat_id} ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+
+async def send_message(bot, chat_id: int, text: str, **kwargs):
+    """bot.send_message through the outbound limits (not retried once possibly sent)."""
+    return await call(chat_id, bot.send_message, chat_id=chat_id, text=text, idempotent=False, **kwargs)
+
+
+async def edit_message_text(bot, chat_id: int, message_id: int, text: str, **kwargs):
+    """bot.edit_message_text through the outbound limits."""
+    return await call(chat_id, bot.edit_message_text, text=text, chat_id=chat_id, message_id=message_id, **kwargs)
@@ -0,0 +1,51 @@
+"""
+Minimal asyncio pipeline: stages of workers connected by bounded queues.
+"""
+
+import asyncio
+
+# End-of-stream marker passed down the queues
+_DONE = object()
+
+
+def feed(items) -> asyncio.Queue:
+    """An already closed input queue holding `items`."""
+    queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+    queue.put_nowait(_DONE)
+    return queue
+
+
+async def stage(inbox: asyncio.Queue, handler, outbox: asyncio.Queue = None, concurrency: int = 1):
+    """
+    Run `concurrency` workers passing items from inbox to the async `handler`
+    until inbox is closed. Items the handler returns (an iterable) go to outbox,
+    which waits for room when full, and outbox is closed once all workers finish.
+    """
+    async def worker():
+        while True:
+            item = await inbox.get()
+            if item is _DONE:
+                inbox.put_nowait(_DONE)  # Let sibling workers see it too (the slot was just freed)
+                return
+            results = await handler(item)
+            if outbox is not None:
+                for result in results or ():
+                    await outbox.put(result)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    if outbox is not None:
+        await outbox.put(_DONE)
+
+
+async def run(*stages):
+    """Run stages concurrently; if one fails, cancel the rest and re-raise."""
+    tasks = [asyncio.ensure_future(s) for s in stages]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
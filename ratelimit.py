@@ -0,0 +1,57 @@
+"""
+Async rate limiting helpers shared by the API clients.
+"""
+
+import asyncio
+import random
+import time
+
+
+class TokenBucket:
+    """
+    Async token bucket: refills `rate` tokens per second and holds up to `burst`.
+    A rate of 0 (or less) disables limiting.
+    """
+
+    def __init__(self, rate: float, burst: float = 1):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float = 1):
+        """Wait until `tokens` are available and take them (callers are served in order)."""
+        if self.rate <= 0:
+            return
+        # A request bigger than the bucket would wait forever; let it drain the bucket instead
+        tokens = min(tokens, self.burst)
+
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Hold all callers for `seconds` (e.g. server asked us to back off)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff with jitter: half fixed, half random, capped at `cap`."""
+    delay = min(cap, base * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
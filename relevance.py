@@ -0,0 +1,129 @@
+"""
+Cheap local relevance check (BM25 term saturation), run before the LLM.
+Clear keyword misses are rejected, and vacancies whose title the resume already
+covers are accepted, without an AI request.
+"""
+
+import logging
+import re
+from collections import Counter
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Words with tech punctuation kept intact (c++, c#, 1с); dots and hyphens split
+# words, so vue.js and Python-разработчик match vue and python
+_TOKEN_RE = re.compile(r"[a-zа-яё0-9][a-zа-яё0-9+#]*")
+_TAG_RE = re.compile(r"<[^>]+>")  # HH highlights matches in snippets with <highlighttext>
+_STOPWORDS = {
+    "и", "в", "во", "на", "с", "со", "по", "для", "от", "до", "из", "к", "о", "об", "у", "а", "не", "или", "за",
+    "the", "a", "an", "and", "or", "of", "in", "on", "to", "for", "with", "at", "by",
+}
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# Decisions made locally since start: "rejected", "accepted", "ambiguous" (sent to the LLM)
+_stats = Counter()
+
+
+def _stem(token: str) -> str:
+    """Crude stemming: long words are cut to a prefix, so word forms match (разработчик/разработка)."""
+    return token[:6] if len(token) > 6 and token.isalpha() else token
+
+
+def tokenize(text: str) -> list:
+    """Lowercased, stemmed word tokens without stopwords and markup."""
+    tokens = _TOKEN_RE.findall(_TAG_RE.sub(" ", text or "").lower())
+    return [_stem(token) for token in tokens if token not in _STOPWORDS]
+
+
+def _document(vacancy) -> list:
+    """Tokens of a vacancy: title, then requirement and responsibility snippets."""
+    return tokenize(vacancy.name) + tokenize(vacancy.requirement) + tokenize(vacancy.responsibility)
+
+
+def relevance_scores(vacancies: list, query: str) -> dict:
+    """
+    BM25 relevance of each vacancy to the query, scaled to 0..1.
+
+    Every query term weighs the same: the candidates all come from a search for
+    the query, so idf over them would penalise exactly the terms that matter.
+    A vacancy that mentions every query term once at average length scores about
+    1 (repeats push it a little higher, capped at 1); one with none of them scores 0.
+    Returns {vacancy_id: score}, or {} if the query has no usable terms.
+    """
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not vacancies or not terms:
+        return {}
+
+    documents = [_document(vac) for vac in vacancies]
+    avg_len = sum(len(doc) for doc in documents) / len(documents) or 1
+
+    scores = {}
+    for vac, doc in zip(vacancies, documents):
+        tf = Counter(doc)
+        norm = K1 * (1 - B + B * len(doc) / avg_len)
+        score = sum(tf[term] * (K1 + 1) / (tf[term] + norm) for term in terms if tf[term])
+        scores[vac.id] = min(1.0, score / len(terms))
+    return scores
+
+
+def _resume_overlap(vacancy, resume_terms: set) -> float:
+    """Share of the vacancy title's terms that appear in the resume."""
+    title = set(tokenize(vacancy.name))
+    return len(title & resume_terms) / len(title) if title else 0.0
+
+
+def triage(vacancies: list, query: str, resume_text: str = None) -> tuple[list, list, list]:
+    """
+    Split vacancies into (rejected, accepted, ambiguous) by local relevance.
+
+    Below RELEVANCE_REJECT_BELOW (by default: no query term at all) is a clear
+    miss, unless the title shares words with the resume. The query match alone
+    never accepts: HH searches titles, so nearly every result has the query in
+    its title. A clear hit also needs a resume that covers at least
+    RELEVANCE_ACCEPT_ABOVE of the title's words. Everything else needs the LLM.
+    """
+    scores = relevance_scores(vacancies, query)
+    if not scores:
+        _stats["ambiguous"] += len(vacancies)
+        return [], [], list(vacancies)
+
+    resume_terms = set(tokenize(resume_text)) if resume_text else set()
+
+    rejected, accepted, ambiguous = [], [], []
+    for vac in vacancies:
+        score = scores[vac.id]
+        overlap = _resume_overlap(vac, resume_terms) if resume_terms else 0.0
+        if score < config.RELEVANCE_REJECT_BELOW:
+            if overlap:
+                ambiguous.append(vac)
+            else:
+                rejected.append(vac)
+        elif overlap >= config.RELEVANCE_ACCEPT_ABOVE:
+            accepted.append(vac)
+        else:
+            ambiguous.append(vac)
+
+    _stats["rejected"] += len(rejected)
+    _stats["accepted"] += len(accepted)
+    _stats["ambiguous"] += len(ambiguous)
+    if rejected or accepted:
+        logger.info(
+            f"Relevance pre-filter for '{query}': {len(rejected)} rejected, {len(accepted)} accepted, "
+            f"{len(ambiguous)} to AI ({llm_calls_saved()} AI scorings saved so far)"
+        )
+    return rejected, accepted, ambiguous
+
+
+def llm_calls_saved() -> int:
+    """Vacancies decided locally since start, i.e. AI scorings skipped."""
+    return _stats["rejected"] + _stats["accepted"]
+
+
+def stats() -> dict:
+    """Counters for logging and /stats."""
+    return dict(_stats, saved=llm_calls_saved())
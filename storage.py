@@ -1,7 +1,14 @@
 import sqlite3
 import os
+import json
 import logging
-from typing import List, Dict, Any
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from typing import List, Dict, Any, Optional
+
+import config
+from hh_client import Vacancy
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -10,9 +17,38 @@ DATA_DIR = "data"
 DB_NAME = os.path.join(DATA_DIR, "vacancies.db")
 
 
-def _get_conn():
-    """Get database connection."""
-    return sqlite3.connect(DB_NAME)
+# Sent / hidden rows from before per-chat delivery: they apply to every chat
+LEGACY_CHAT_ID = 0
+
+# Long-lived connection shared by the whole process (see _get_conn / close_db)
+_conn: Optional[sqlite3.Connection] = None
+
+
+def _get_conn() -> sqlite3.Connection:
+    """
+    Get the shared database connection, opening it on first use.
+    
+    WAL lets readers proceed while a write is in progress, and synchronous=NORMAL
+    only fsyncs at checkpoints (safe with WAL). Statements are prepared once per
+    connection and reused from its statement cache.
+    """
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(DB_NAME, timeout=10, cached_statements=256)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        _conn.execute(f"PRAGMA cache_size=-{config.SQLITE_CACHE_KB}")
+        _conn.execute(f"PRAGMA mmap_size={config.SQLITE_MMAP_MB * 1024 * 1024}")
+        _conn.execute("PRAGMA temp_store=MEMORY")
+    return _conn
+
+
+def close_db():
+    """Close the shared connection (on shutdown)."""
+    global _conn
+    if _conn is not None:
+        _conn.close()
+        _conn = None
 
 
 def init_db():
@@ -23,31 +59,37 @@ def init_db():
     conn = _get_conn()
     cursor = conn.cursor()
     
-    # Sent vacancies (deduplication)
+    # Sent vacancies (deduplication, per chat)
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS sent_vacancies (
-            id TEXT PRIMARY KEY,
-            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            chat_id INTEGER NOT NULL,
+            id TEXT NOT NULL,
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (chat_id, id)
         )
     """)
     
-    # Favorites
+    # Favorites (per chat)
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS favorites (
-            id TEXT PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            id TEXT NOT NULL,
             title TEXT,
             url TEXT,
             employer TEXT,
             salary TEXT,
-            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (chat_id, id)
         )
     """)
     
-    # Hidden vacancies
+    # Hidden vacancies (per chat)
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS hidden (
-            id TEXT PRIMARY KEY,
-            hidden_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            chat_id INTEGER NOT NULL,
+            id TEXT NOT NULL,
+            hidden_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (chat_id, id)
         )
     """)
     
@@ -63,10 +105,66 @@ def init_db():
             area INTEGER DEFAULT 113,
             remote_only BOOLEAN DEFAULT 0,
             search_depth INTEGER DEFAULT 1,
-            resume_text TEXT
+            resume_text TEXT,
+            thread_id INTEGER,
+            active INTEGER DEFAULT 1
         )
     ''')
     
+    # Delivered vacancies, so buttons keep working after cache eviction or restart
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS vacancies (
+            id TEXT PRIMARY KEY,
+            data TEXT,
+            stored_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Newest publication time seen per chat and query (incremental polling)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS query_watermarks (
+            chat_id INTEGER,
+            query TEXT,
+            published_at TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (chat_id, query)
+        )
+    """)
+    
+    # Rendered vacancy messages waiting for (or done with) delivery.
+    # Queued in the same transaction that marks the vacancy sent to the chat.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            thread_id INTEGER,
+            vacancy_id TEXT,
+            text TEXT,
+            keyboard TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP,
+            UNIQUE (chat_id, vacancy_id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (status, chat_id, id)")
+    
+    # AI scores, reused until the vacancy, query, prompt or model changes
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ai_scores (
+            vacancy_id TEXT,
+            fingerprint TEXT,
+            prompt_version INTEGER,
+            model TEXT,
+            score INTEGER,
+            reasoning TEXT,
+            scored_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (vacancy_id, fingerprint, prompt_version, model)
+        )
+    """)
+    
     # Vacancy statistics for analytics
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS vacancy_stats (
@@ -80,85 +178,443 @@ def init_db():
     """)
     
     conn.commit()
-    conn.close()
+    
+    _migrate(conn)
+    _load_indexes()
+
+
+# ============ Schema Migrations ============
+
+def _add_column(conn: sqlite3.Connection, table: str, column: str, definition: str):
+    """ALTER TABLE ... ADD COLUMN, skipped if the column already exists."""
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _migration_1(conn: sqlite3.Connection):
+    """chat_settings columns added after the first release."""
+    _add_column(conn, "chat_settings", "search_depth", "INTEGER DEFAULT 1")
+    _add_column(conn, "chat_settings", "area", "INTEGER DEFAULT 113")
+    _add_column(conn, "chat_settings", "resume_text", "TEXT")
+
+
+def _key_by_chat(conn: sqlite3.Connection, table: str, time_column: str):
+    """
+    Rebuild a global (id) table as per-chat (chat_id, id). Existing rows are kept
+    under LEGACY_CHAT_ID, which every chat checks, so nothing already sent is sent again.
+    """
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if "chat_id" in columns:
+        return
+    conn.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+    conn.execute(f"""
+        CREATE TABLE {table} (
+            chat_id INTEGER NOT NULL,
+            id TEXT NOT NULL,
+            {time_column} TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (chat_id, id)
+        )
+    """)
+    conn.execute(f"""
+        INSERT INTO {table} (chat_id, id, {time_column})
+        SELECT ?, id, {time_column} FROM {table}_legacy
+    """, (LEGACY_CHAT_ID,))
+    conn.execute(f"DROP TABLE {table}_legacy")
+
+
+def _migration_2(conn: sqlite3.Connection):
+    """Per-chat delivery: thread and active flag in chat_settings, sent/hidden keyed by chat."""
+    _add_column(conn, "chat_settings", "thread_id", "INTEGER")
+    _add_column(conn, "chat_settings", "active", "INTEGER DEFAULT 1")
+    _key_by_chat(conn, "sent_vacancies", "sent_at")
+    _key_by_chat(conn, "hidden", "hidden_at")
+
+
+def _migration_3(conn: sqlite3.Connection):
+    """Outbox retry backoff: next_attempt_at (NULL = due now)."""
+    _add_column(conn, "outbox", "next_attempt_at", "TIMESTAMP")
+
+
+def _migration_4(conn: sqlite3.Connection):
+    """Per-chat favorites: keyed by (chat_id, id)."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(favorites)")}
+    if "chat_id" in columns:
+        return
+    conn.execute("ALTER TABLE favorites RENAME TO favorites_legacy")
+    conn.execute("""
+        CREATE TABLE favorites (
+            chat_id INTEGER NOT NULL,
+            id TEXT NOT NULL,
+            title TEXT,
+            url TEXT,
+            employer TEXT,
+            salary TEXT,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (chat_id, id)
+        )
+    """)
+    # Every known chat saw the global list; with none known, the first chat to register claims it
+    conn.execute("""
+        INSERT INTO favorites (chat_id, id, title, url, employer, salary, added_at)
+        SELECT c.chat_id, l.id, l.title, l.url, l.employer, l.salary, l.added_at
+        FROM favorites_legacy l CROSS JOIN (
+            SELECT chat_id FROM chat_settings
+            UNION ALL SELECT ? WHERE NOT EXISTS (SELECT 1 FROM chat_settings)
+        ) c
+    """, (LEGACY_CHAT_ID,))
+    conn.execute("DROP TABLE favorites_legacy")
+
+
+# Applied in order, once; PRAGMA user_version stores how many have run
+_MIGRATIONS = [
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+]
+
+
+def _migrate(conn: sqlite3.Connection):
+    """Run pending schema migrations, each in its own transaction."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(_MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        logger.info(f"Applied schema migration {number}: {migration.__doc__}")
+
+
+# ============ Dedupe Index ============
+
+_MAX_ID = 2 ** 63 - 1
+
+
+def _numeric_id(vacancy_id) -> Optional[int]:
+    """HH ids are decimal strings; return the int if it round-trips exactly."""
+    if isinstance(vacancy_id, str) and vacancy_id.isdigit() and (vacancy_id == "0" or vacancy_id[0] != "0"):
+        value = int(vacancy_id)
+        if value <= _MAX_ID:
+            return value
+    return None
+
+
+class _IdIndex:
+    """
+    Compact in-memory set of vacancy ids.
+    Numeric ids are kept in a sorted array('q') (8 bytes each) and looked up with
+    bisect; anything non-numeric falls back to a regular set.
+    """
+    __slots__ = ("_ids", "_other")
+
+    def __init__(self, vacancy_ids=()):
+        numbers = set()
+        self._other = set()
+        for vac_id in vacancy_ids:
+            number = _numeric_id(vac_id)
+            if number is None:
+                self._other.add(vac_id)
+            else:
+                numbers.add(number)
+        self._ids = array("q", sorted(numbers))
+
+    def __len__(self):
+        return len(self._ids) + len(self._other)
+
+    def __contains__(self, vacancy_id) -> bool:
+        number = _numeric_id(vacancy_id)
+        if number is None:
+            return vacancy_id in self._other
+        i = bisect_left(self._ids, number)
+        return i < len(self._ids) and self._ids[i] == number
+
+    def add(self, vacancy_id):
+        number = _numeric_id(vacancy_id)
+        if number is None:
+            self._other.add(vacancy_id)
+            return
+        i = bisect_left(self._ids, number)
+        if i == len(self._ids) or self._ids[i] != number:
+            self._ids.insert(i, number)
+
+
+# Sent / hidden ids per chat, loaded once by init_db and kept in sync on every write
+_sent_index: Optional[Dict[int, _IdIndex]] = None
+_hidden_index: Optional[Dict[int, _IdIndex]] = None
+
+
+def _load_index(table: str) -> Dict[int, _IdIndex]:
+    ids_by_chat = defaultdict(list)
+    for chat_id, vac_id in _get_conn().execute(f"SELECT chat_id, id FROM {table}"):
+        ids_by_chat[chat_id].append(vac_id)
+    return {chat_id: _IdIndex(ids) for chat_id, ids in ids_by_chat.items()}
+
+
+def _load_indexes():
+    global _sent_index, _hidden_index
+    _sent_index = _load_index("sent_vacancies")
+    _hidden_index = _load_index("hidden")
+    logger.info(
+        f"Dedupe index loaded: {sum(map(len, _sent_index.values()))} sent, "
+        f"{sum(map(len, _hidden_index.values()))} hidden, {len(_sent_index)} chats"
+    )
+
+
+def _indexes(chat_id: int):
+    """(sent, hidden) index of a chat."""
+    if _sent_index is None:
+        _load_indexes()
+    sent = _sent_index.setdefault(chat_id, _IdIndex())
+    hidden = _hidden_index.setdefault(chat_id, _IdIndex())
+    return sent, hidden
 
 
 # ============ Sent Vacancies ============
 
-def is_sent(vacancy_id: str) -> bool:
+def mark_sent_many(chat_id: int, vacancy_ids):
+    """Mark a batch of vacancies as sent to a chat in a single transaction."""
+    if not vacancy_ids:
+        return
+    conn = _get_conn()
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO sent_vacancies (chat_id, id) VALUES (?, ?)",
+            [(chat_id, vac_id) for vac_id in vacancy_ids]
+        )
+    sent, _ = _indexes(chat_id)
+    for vac_id in vacancy_ids:
+        sent.add(vac_id)
+
+
+def filter_unseen(chat_id: int, vacancy_ids: List[str]) -> List[str]:
+    """Return the ids neither sent to nor hidden in a chat, in input order (in-memory lookup)."""
+    seen = _indexes(chat_id) + _indexes(LEGACY_CHAT_ID)
+    return [vac_id for vac_id in vacancy_ids if not any(vac_id in index for index in seen)]
+
+
+# ============ Outbox ============
+
+def enqueue_outbox(chat_id: int, thread_id: Optional[int], vacancy_id: str, text: str, keyboard: str) -> bool:
+    """
+    Queue a rendered vacancy message for a chat and mark the vacancy sent, in one
+    transaction. Returns False if it was already queued for the chat.
+    """
+    conn = _get_conn()
+    with conn:
+        cursor = conn.execute(
+            """INSERT OR IGNORE INTO outbox (chat_id, thread_id, vacancy_id, text, keyboard)
+               VALUES (?, ?, ?, ?, ?)""",
+            (chat_id, thread_id, vacancy_id, text, keyboard)
+        )
+        conn.execute("INSERT OR IGNORE INTO sent_vacancies (chat_id, id) VALUES (?, ?)", (chat_id, vacancy_id))
+    sent, _ = _indexes(chat_id)
+    sent.add(vacancy_id)
+    return cursor.rowcount > 0
+
+
+def get_outbox_chat_ids() -> List[int]:
+    """Chats with messages waiting for delivery."""
+    conn = _get_conn()
+    cursor = conn.execute("SELECT DISTINCT chat_id FROM outbox WHERE status = 'pending'")
+    return [row[0] for row in cursor.fetchall()]
+
+
+def get_pending_outbox(chat_id: int, limit: int = 100) -> List[Dict[str, Any]]:
+    """
+    Messages due for delivery to a chat, oldest first. A message waiting out its
+    retry delay holds back the ones queued after it, so the chat keeps its order.
+    """
+    conn = _get_conn()
+    cursor = conn.execute(
+        """SELECT id, thread_id, vacancy_id, text, keyboard, attempts FROM outbox
+           WHERE status = 'pending' AND chat_id = ? AND id < COALESCE((
+               SELECT MIN(id) FROM outbox
+               WHERE status = 'pending' AND chat_id = ? AND next_attempt_at > datetime('now')
+           ), 9223372036854775807)
+           ORDER BY id LIMIT ?""",
+        (chat_id, chat_id, limit)
+    )
+    return [
+        {"id": r[0], "thread_id": r[1], "vacancy_id": r[2], "text": r[3], "keyboard": r[4], "attempts": r[5]}
+        for r in cursor.fetchall()
+    ]
+
+
+def mark_outbox_delivered(message_id: int):
+    """Record that an outbox message reached Telegram."""
+    conn = _get_conn()
+    with conn:
+        conn.execute(
+            "UPDATE outbox SET status = 'sent', attempts = attempts + 1, sent_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (message_id,)
+        )
+
+
+def mark_outbox_failed(message_id: int, max_attempts: int, retry_in: float = 0) -> bool:
+    """
+    Count a failed delivery and hold the message back for retry_in seconds;
+    gives up after max_attempts. Returns True if given up.
+    """
+    conn = _get_conn()
+    with conn:
+        conn.execute(
+            """UPDATE outbox SET attempts = attempts + 1,
+                   status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE status END,
+                   next_attempt_at = datetime('now', ?)
+               WHERE id = ?""",
+            (max_attempts, f"+{int(retry_in)} seconds", message_id)
+        )
+        cursor = conn.execute("SELECT status FROM outbox WHERE id = ?", (message_id,))
+        return cursor.fetchone()[0] == 'failed'
+
+
+def drop_outbox(chat_id: int) -> int:
+    """Give up all pending messages of a chat (e.g. the bot was removed). Returns rows dropped."""
+    conn = _get_conn()
+    with conn:
+        cursor = conn.execute(
+            "UPDATE outbox SET status = 'dropped' WHERE chat_id = ? AND status = 'pending'",
+            (chat_id,)
+        )
+    return cursor.rowcount
+
+
+def prune_outbox(max_age_days: int) -> int:
+    """Delete finished outbox messages older than max_age_days. Returns rows removed."""
+    conn = _get_conn()
+    with conn:
+        cursor = conn.execute(
+            "DELETE FROM outbox WHERE status != 'pending' AND created_at < datetime('now', ?)",
+            (f"-{max_age_days} days",)
+        )
+    return cursor.rowcount
+
+
+# ============ Stored Vacancies ============
+
+def save_vacancy(vacancy: Vacancy):
+    """Persist vacancy data (fallback for the in-memory vacancy cache)."""
     conn = _get_conn()
     cursor = conn.cursor()
-    cursor.execute("SELECT 1 FROM sent_vacancies WHERE id = ?", (vacancy_id,))
+    cursor.execute(
+        "INSERT OR REPLACE INTO vacancies (id, data) VALUES (?, ?)",
+        (vacancy.id, json.dumps(vacancy.to_dict(), ensure_ascii=False))
+    )
+    conn.commit()
+
+
+def get_vacancy(vacancy_id: str) -> Optional[Vacancy]:
+    """Load stored vacancy data, or None if we never stored it."""
+    conn = _get_conn()
+    cursor = conn.cursor()
+    cursor.execute("SELECT data FROM vacancies WHERE id = ?", (vacancy_id,))
     result = cursor.fetchone()
-    conn.close()
-    return result is not None
+    return Vacancy.from_dict(json.loads(result[0])) if result else None
 
 
-def mark_sent(vacancy_id: str):
+def prune_vacancies(max_age_days: int) -> int:
+    """Delete stored vacancy data older than max_age_days. Returns rows removed."""
     conn = _get_conn()
     cursor = conn.cursor()
-    cursor.execute("INSERT OR IGNORE INTO sent_vacancies (id) VALUES (?)", (vacancy_id,))
+    cursor.execute(
+        "DELETE FROM vacancies WHERE stored_at < datetime('now', ?)",
+        (f"-{max_age_days} days",)
+    )
+    removed = cursor.rowcount
     conn.commit()
-    conn.close()
+    return removed
+
+
+# ============ AI Score Cache ============
+
+def get_ai_score(vacancy_id: str, fingerprint: str, prompt_version: int, model: str,
+                 max_age_days: int) -> Optional[tuple]:
+    """Get a cached (score, reasoning) younger than max_age_days, or None."""
+    conn = _get_conn()
+    cursor = conn.cursor()
+    cursor.execute(
+        """SELECT score, reasoning FROM ai_scores
+           WHERE vacancy_id = ? AND fingerprint = ? AND prompt_version = ? AND model = ?
+             AND scored_at >= datetime('now', ?)""",
+        (vacancy_id, fingerprint, prompt_version, model, f"-{max_age_days} days")
+    )
+    result = cursor.fetchone()
+    return (result[0], json.loads(result[1])) if result else None
+
+
+def save_ai_score(vacancy_id: str, fingerprint: str, prompt_version: int, model: str,
+                  score: int, reasoning: dict):
+    """Cache an AI score."""
+    conn = _get_conn()
+    with conn:
+        conn.execute(
+            """INSERT OR REPLACE INTO ai_scores
+               (vacancy_id, fingerprint, prompt_version, model, score, reasoning) VALUES (?, ?, ?, ?, ?, ?)""",
+            (vacancy_id, fingerprint, prompt_version, model, score, json.dumps(reasoning, ensure_ascii=False))
+        )
+
+
+def prune_ai_scores(max_age_days: int) -> int:
+    """Delete cached AI scores older than max_age_days. Returns rows removed."""
+    conn = _get_conn()
+    with conn:
+        cursor = conn.execute(
+            "DELETE FROM ai_scores WHERE scored_at < datetime('now', ?)",
+            (f"-{max_age_days} days",)
+        )
+    return cursor.rowcount
 
 
 # ============ Favorites ============
 
-def add_favorite(vacancy: Dict[str, Any]) -> bool:
-    """Add vacancy to favorites. Returns True if added, False if already exists."""
+def add_favorite(chat_id: int, vacancy: Vacancy) -> bool:
+    """Add vacancy to a chat's favorites. Returns True if added, False if already exists."""
     conn = _get_conn()
     cursor = conn.cursor()
     
-    vac_id = vacancy.get("id")
-    title = vacancy.get("name", "")
-    url = vacancy.get("alternate_url", "")
-    employer = vacancy.get("employer", {}).get("name", "")
-    
-    salary = vacancy.get("salary")
-    salary_str = ""
-    if salary:
-        _from = salary.get("from")
-        _to = salary.get("to")
-        currency = salary.get("currency", "")
-        if _from and _to:
-            salary_str = f"{_from} - {_to} {currency}"
-        elif _from:
-            salary_str = f"от {_from} {currency}"
-        elif _to:
-            salary_str = f"до {_to} {currency}"
+    vac_id = vacancy.id
+    title = vacancy.name
+    url = vacancy.url
+    employer = vacancy.employer
+    salary_str = vacancy.salary_text()
     
     try:
-        cursor.execute(
-            "INSERT INTO favorites (id, title, url, employer, salary) VALUES (?, ?, ?, ?, ?)",
-            (vac_id, title, url, employer, salary_str)
-        )
-        conn.commit()
+        with conn:
+            cursor.execute(
+                "INSERT INTO favorites (chat_id, id, title, url, employer, salary) VALUES (?, ?, ?, ?, ?, ?)",
+                (chat_id, vac_id, title, url, employer, salary_str)
+            )
         result = True
     except sqlite3.IntegrityError:
         result = False
     
-    conn.close()
     return result
 
 
-def remove_favorite(vacancy_id: str) -> bool:
-    """Remove vacancy from favorites. Returns True if removed."""
+def remove_favorite(chat_id: int, vacancy_id: str) -> bool:
+    """Remove vacancy from a chat's favorites. Returns True if removed."""
     conn = _get_conn()
     cursor = conn.cursor()
-    cursor.execute("DELETE FROM favorites WHERE id = ?", (vacancy_id,))
+    cursor.execute("DELETE FROM favorites WHERE chat_id = ? AND id = ?", (chat_id, vacancy_id))
     removed = cursor.rowcount > 0
     conn.commit()
-    conn.close()
     return removed
 
 
-def get_favorites() -> List[Dict[str, str]]:
-    """Get all favorite vacancies."""
+def get_favorites(chat_id: int) -> List[Dict[str, str]]:
+    """Get a chat's favorite vacancies."""
     conn = _get_conn()
     cursor = conn.cursor()
-    cursor.execute("SELECT id, title, url, employer, salary FROM favorites ORDER BY added_at DESC")
+    cursor.execute(
+        "SELECT id, title, url, employer, salary FROM favorites WHERE chat_id = ? ORDER BY added_at DESC",
+        (chat_id,)
+    )
     rows = cursor.fetchall()
-    conn.close()
     
     return [
         {"id": r[0], "title": r[1], "url": r[2], "employer": r[3], "salary": r[4]}
@@ -166,74 +622,61 @@ def get_favorites() -> List[Dict[str, str]]:
     ]
 
 
-def is_favorite(vacancy_id: str) -> bool:
+def is_favorite(chat_id: int, vacancy_id: str) -> bool:
     conn = _get_conn()
     cursor = conn.cursor()
-    cursor.execute("SELECT 1 FROM favorites WHERE id = ?", (vacancy_id,))
+    cursor.execute("SELECT 1 FROM favorites WHERE chat_id = ? AND id = ?", (chat_id, vacancy_id))
     result = cursor.fetchone()
-    conn.close()
     return result is not None
 
 
+def claim_legacy_favorites(chat_id: int) -> int:
+    """Move favorites saved before per-chat favorites (no chat known then) to a chat. Returns rows moved."""
+    conn = _get_conn()
+    with conn:
+        cursor = conn.execute("UPDATE favorites SET chat_id = ? WHERE chat_id = ?", (chat_id, LEGACY_CHAT_ID))
+    return cursor.rowcount
+
+
 # ============ Hidden ============
 
-def hide_vacancy(vacancy_id: str) -> bool:
-    """Hide a vacancy. Returns True if hidden."""
+def hide_vacancy(chat_id: int, vacancy_id: str) -> bool:
+    """Hide a vacancy in a chat. Returns True if hidden."""
     conn = _get_conn()
     cursor = conn.cursor()
     try:
-        cursor.execute("INSERT INTO hidden (id) VALUES (?)", (vacancy_id,))
-        conn.commit()
+        with conn:
+            cursor.execute("INSERT INTO hidden (chat_id, id) VALUES (?, ?)", (chat_id, vacancy_id))
         result = True
     except sqlite3.IntegrityError:
         result = False
-    conn.close()
+    _indexes(chat_id)[1].add(vacancy_id)
     return result
 
 
-def is_hidden(vacancy_id: str) -> bool:
-    conn = _get_conn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT 1 FROM hidden WHERE id = ?", (vacancy_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None
+# ============ Chat Settings ============
 
+# chat_id -> settings dict; filled on first read, dropped by update_chat_setting
+_settings_cache: Dict[int, Dict[str, Any]] = {}
 
-# ============ Chat Settings ============
 
 def get_chat_settings(chat_id: int) -> Dict[str, Any]:
     """Get settings for a specific chat. Returns defaults if not found."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    # Check for search_depth column and add if missing (migration)
-    try:
-        cursor.execute("SELECT search_depth FROM chat_settings LIMIT 1")
-    except sqlite3.OperationalError:
-        cursor.execute("ALTER TABLE chat_settings ADD COLUMN search_depth INTEGER DEFAULT 1")
-        conn.commit()
+    cached = _settings_cache.get(chat_id)
+    if cached is None:
+        cached = _settings_cache[chat_id] = _load_chat_settings(chat_id)
+    return dict(cached)  # Copy, so callers can't modify the cached entry
 
-    # Check for area column and add if missing (migration)
-    try:
-        cursor.execute("SELECT area FROM chat_settings LIMIT 1")
-    except sqlite3.OperationalError:
-        cursor.execute("ALTER TABLE chat_settings ADD COLUMN area INTEGER DEFAULT 113")
-        conn.commit()
 
-    # Check for resume_text column and add if missing (migration)
-    try:
-        cursor.execute("SELECT resume_text FROM chat_settings LIMIT 1")
-    except sqlite3.OperationalError:
-        cursor.execute("ALTER TABLE chat_settings ADD COLUMN resume_text TEXT")
-        conn.commit()
-    
+def _load_chat_settings(chat_id: int) -> Dict[str, Any]:
+    conn = _get_conn()
+    cursor = conn.cursor()
     cursor.execute(
-        "SELECT search_query, min_salary, experience, area, remote_only, search_depth, resume_text FROM chat_settings WHERE chat_id = ?", 
+        """SELECT search_query, min_salary, experience, area, remote_only, search_depth, resume_text, thread_id, active
+           FROM chat_settings WHERE chat_id = ?""", 
         (chat_id,)
     )
     result = cursor.fetchone()
-    conn.close()
     
     if result:
         return {
@@ -242,67 +685,93 @@ def get_chat_settings(chat_id: int) -> Dict[str, Any]:
             "experience": result[2],
             "area": result[3],
             "remote_only": bool(result[4]),
-            "area": result[3],
-            "remote_only": bool(result[4]),
             "search_depth": result[5] if result[5] is not None else 1,
-            "resume_text": result[6]
+            "resume_text": result[6],
+            "thread_id": result[7],
+            "active": bool(result[8])
         }
     else:
         # Default settings from environment
-        import config
         return {
             "search_query": config.SEARCH_QUERY,
             "min_salary": config.MIN_SALARY,
             "experience": config.EXPERIENCE,
             "area": config.AREA,
             "remote_only": config.REMOTE_ONLY,
-            "area": config.AREA,
-            "remote_only": config.REMOTE_ONLY,
             "search_depth": 1,
-            "resume_text": None
+            "resume_text": None,
+            "thread_id": None,
+            "active": False
         }
 
 
 def update_chat_setting(chat_id: int, key: str, value: Any) -> bool:
     """Update a single setting for a chat."""
-    valid_keys = ["search_query", "min_salary", "experience", "area", "remote_only", "search_depth", "resume_text"]
+    valid_keys = ["search_query", "min_salary", "experience", "area", "remote_only", "search_depth", "resume_text", "thread_id", "active"]
     
     if key not in valid_keys:
         return False
         
-    conn = sqlite3.connect(DB_NAME, timeout=10) # Added timeout
-    cursor = conn.cursor()
+    conn = _get_conn()
     
     try:
-        # First ensure the chat exists in settings
-        cursor.execute(
-            "INSERT OR IGNORE INTO chat_settings (chat_id) VALUES (?)",
-            (chat_id,)
-        )
-        
-        # Convert remote_only to int if it's the key
-        if key == "remote_only":
-            value = 1 if value else 0
-        
-        query = f"UPDATE chat_settings SET {key} = ? WHERE chat_id = ?"
-        cursor.execute(query, (value, chat_id))
+        with conn:
+            cursor = conn.cursor()
+            # First ensure the chat exists in settings, starting from the environment defaults
+            cursor.execute(
+                """INSERT OR IGNORE INTO chat_settings (chat_id, min_salary, experience, area, remote_only)
+                   VALUES (?, ?, ?, ?, ?)""",
+                (chat_id, config.MIN_SALARY, config.EXPERIENCE, config.AREA, int(config.REMOTE_ONLY))
+            )
+            
+            # Convert flags to int
+            if key in ("remote_only", "active"):
+                value = 1 if value else 0
+            
+            query = f"UPDATE chat_settings SET {key} = ? WHERE chat_id = ?"
+            cursor.execute(query, (value, chat_id))
         
-        conn.commit()
         logger.info(f"Updated setting {key}={value} for chat {chat_id}")
         return True
     except Exception as e:
         logger.error(f"DB Error: {e}")
         return False
     finally:
-        conn.close()
-    return True
+        _settings_cache.pop(chat_id, None)
+
+
+def get_active_chat_ids() -> List[int]:
+    """Chats that receive vacancies (registered via /start or /jobs, bot not removed)."""
+    cursor = _get_conn().cursor()
+    cursor.execute("SELECT chat_id FROM chat_settings WHERE active = 1 ORDER BY chat_id")
+    return [row[0] for row in cursor.fetchall()]
 
 
-def get_chat_queries(chat_id: int) -> List[str]:
-    """Get search queries as a list for a chat."""
-    settings = get_chat_settings(chat_id)
-    query = settings.get("search_query", "")
-    return [q.strip() for q in query.split(",") if q.strip()]
+# ============ Polling Watermarks ============
+
+def get_watermark(chat_id: int, query: str) -> Optional[str]:
+    """Get newest 'published_at' seen for a chat's query, or None on first run."""
+    conn = _get_conn()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT published_at FROM query_watermarks WHERE chat_id = ? AND query = ?",
+        (chat_id, query)
+    )
+    result = cursor.fetchone()
+    return result[0] if result else None
+
+
+def set_watermark(chat_id: int, query: str, published_at: str):
+    """Store newest 'published_at' seen for a chat's query."""
+    conn = _get_conn()
+    cursor = conn.cursor()
+    cursor.execute(
+        """INSERT INTO query_watermarks (chat_id, query, published_at) VALUES (?, ?, ?)
+           ON CONFLICT(chat_id, query) DO UPDATE
+           SET published_at = excluded.published_at, updated_at = CURRENT_TIMESTAMP""",
+        (chat_id, query, published_at)
+    )
+    conn.commit()
 
 
 # ============ Analytics ============
@@ -333,7 +802,6 @@ def record_vacancy_stats(query: str, vacancy_count: int, avg_salary: int, top_em
         )
     
     conn.commit()
-    conn.close()
 
 
 def get_weekly_stats() -> Dict[str, Any]:
@@ -372,7 +840,6 @@ def get_weekly_stats() -> Dict[str, Any]:
     """)
     daily = [{"date": r[0], "count": r[1]} for r in cursor.fetchall()]
     
-    conn.close()
     
     return {
         "total_vacancies": total_vacancies,
@@ -382,21 +849,22 @@ def get_weekly_stats() -> Dict[str, Any]:
     }
 
 
-def get_total_sent_count() -> int:
-    """Get total number of sent vacancies."""
+def get_total_sent_count(chat_id: int = None) -> int:
+    """Get total number of sent vacancies (for one chat, or for all chats)."""
     conn = _get_conn()
     cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM sent_vacancies")
+    if chat_id is None:
+        cursor.execute("SELECT COUNT(*) FROM sent_vacancies")
+    else:
+        cursor.execute("SELECT COUNT(*) FROM sent_vacancies WHERE chat_id = ?", (chat_id,))
     count = cursor.fetchone()[0]
-    conn.close()
     return count
 
 
-def get_favorites_count() -> int:
-    """Get number of favorites."""
+def get_favorites_count(chat_id: int) -> int:
+    """Get number of a chat's favorites."""
     conn = _get_conn()
     cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM favorites")
+    cursor.execute("SELECT COUNT(*) FROM favorites WHERE chat_id = ?", (chat_id,))
     count = cursor.fetchone()[0]
-    conn.close()
     return count
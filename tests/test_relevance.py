@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+import relevance
+
+
+def _vacancy(vac_id, name, requirement="", responsibility=""):
+    return SimpleNamespace(id=vac_id, name=name, requirement=requirement, responsibility=responsibility)
+
+
+def _names(vacancies):
+    return [vac.name for vac in vacancies]
+
+
+def test_tokenize_splits_dots_and_hyphens():
+    assert relevance.tokenize("Vue.js / Python-разработчик, C++ и C#") == ["vue", "js", "python", "разраб", "c++", "c#"]
+
+
+def test_title_match_alone_is_not_accepted():
+    vacancies = [
+        _vacancy("1", "QA Engineer (Frontend, React)", "Опыт тестирования веб-приложений"),
+        _vacancy("2", "Frontend-разработчик (React)", "Опыт React от 2 лет"),
+    ]
+    rejected, accepted, ambiguous = relevance.triage(vacancies, "Frontend React")
+    assert rejected == [] and accepted == []
+    assert _names(ambiguous) == _names(vacancies)
+
+
+def test_resume_covering_title_is_accepted():
+    resume = "Frontend-разработчик, 5 лет React, TypeScript"
+    vacancies = [
+        _vacancy("1", "QA Engineer (Frontend, React)", "Опыт тестирования веб-приложений"),
+        _vacancy("2", "Frontend-разработчик (React)", "Опыт React от 2 лет"),
+    ]
+    rejected, accepted, ambiguous = relevance.triage(vacancies, "Frontend React", resume)
+    assert _names(accepted) == ["Frontend-разработчик (React)"]
+    assert _names(ambiguous) == ["QA Engineer (Frontend, React)"]
+
+
+def test_only_vacancies_without_query_terms_are_rejected():
+    vacancies = [
+        _vacancy("1", "Бухгалтер", "Знание 1С"),
+        _vacancy("2", "Fullstack developer", "Vue.js, Node.js"),
+    ]
+    rejected, accepted, ambiguous = relevance.triage(vacancies, "vue.js")
+    assert _names(rejected) == ["Бухгалтер"]
+    assert _names(ambiguous) == ["Fullstack developer"]
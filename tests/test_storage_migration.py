@@ -0,0 +1,104 @@
+import sqlite3
+
+import pytest
+
+import storage
+
+
+# Schema of a database created by the first release (global sent/hidden ids)
+BASELINE_SCHEMA = """
+    CREATE TABLE sent_vacancies (
+        id TEXT PRIMARY KEY,
+        sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE favorites (
+        id TEXT PRIMARY KEY,
+        title TEXT,
+        url TEXT,
+        employer TEXT,
+        salary TEXT,
+        added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE hidden (
+        id TEXT PRIMARY KEY,
+        hidden_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE chat_settings (
+        chat_id INTEGER PRIMARY KEY,
+        search_query TEXT,
+        min_salary INTEGER DEFAULT 0,
+        experience TEXT DEFAULT '',
+        area INTEGER DEFAULT 113,
+        remote_only BOOLEAN DEFAULT 0,
+        search_depth INTEGER DEFAULT 1,
+        resume_text TEXT
+    );
+    CREATE TABLE vacancy_stats (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        date DATE DEFAULT (date('now')),
+        query TEXT,
+        vacancy_count INTEGER DEFAULT 0,
+        avg_salary INTEGER DEFAULT 0,
+        top_employer TEXT DEFAULT ''
+    );
+"""
+
+
+@pytest.fixture
+def baseline_db(tmp_path, monkeypatch):
+    """A baseline-schema database with sent, hidden and favorite history but no chat_settings rows."""
+    db_name = str(tmp_path / "vacancies.db")
+    conn = sqlite3.connect(db_name)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany("INSERT INTO sent_vacancies (id) VALUES (?)", [("101",), ("102",), ("abc",)])
+    conn.execute("INSERT INTO hidden (id) VALUES ('103')")
+    conn.execute("INSERT INTO favorites (id, title) VALUES ('101', 'Python developer')")
+    conn.commit()
+    conn.close()
+
+    storage.close_db()
+    monkeypatch.setattr(storage, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(storage, "DB_NAME", db_name)
+    monkeypatch.setattr(storage, "_sent_index", None)
+    monkeypatch.setattr(storage, "_hidden_index", None)
+    monkeypatch.setattr(storage, "_settings_cache", {})
+    yield db_name
+    storage.close_db()
+
+
+def test_migration_keeps_legacy_history(baseline_db):
+    storage.init_db()
+
+    ids = ["101", "102", "abc", "103", "104"]
+    assert storage.filter_unseen(42, ids) == ["104"]
+    assert storage.filter_unseen(-100500, ids) == ["104"]
+
+    version = storage._get_conn().execute("PRAGMA user_version").fetchone()[0]
+    assert version == len(storage._MIGRATIONS)
+
+
+def test_legacy_history_survives_restart(baseline_db):
+    storage.init_db()
+    storage.close_db()
+    storage.init_db()
+
+    assert storage.filter_unseen(42, ["101", "103", "104"]) == ["104"]
+
+
+def test_legacy_favorites_go_to_the_first_chat(baseline_db):
+    storage.init_db()
+
+    assert storage.claim_legacy_favorites(42) == 1
+    assert storage.claim_legacy_favorites(-100500) == 0
+    assert [fav["title"] for fav in storage.get_favorites(42)] == ["Python developer"]
+    assert storage.get_favorites(-100500) == []
+
+
+def test_favorites_are_per_chat(baseline_db):
+    storage.init_db()
+    storage.claim_legacy_favorites(42)
+
+    assert not storage.is_favorite(-100500, "101")
+    assert storage.remove_favorite(-100500, "101") is False
+    assert storage.get_favorites_count(42) == 1
+    assert storage.get_favorites_count(-100500) == 0